@@ -0,0 +1,91 @@
+class CartLine:
+    __slots__ = ('ref_key', 'description', 'price', 'quantity', 'image')
+
+    def __init__(self, ref_key, description, price, quantity, image=''):
+        self.ref_key = ref_key
+        self.description = description
+        self.price = price
+        self.quantity = quantity
+        self.image = image
+
+    @property
+    def subtotal(self):
+        return self.price * self.quantity
+
+
+def _cents(amount):
+    return round(amount * 100)
+
+
+class Cart:
+    """Корзина: одна строка на товар (по Ref_Key), сумма ведется при каждом изменении в копейках,
+    текст строк собирается один раз после изменения"""
+    __slots__ = ('lines', '_total_cents', '_text')
+
+    def __init__(self):
+        self.lines = {}
+        self._total_cents = 0
+        self._text = None
+
+    def add(self, ref_key, description, price, quantity, image=''):
+        """Добавляет товар; повторное добавление увеличивает количество в той же строке
+        и переводит всю строку на последнюю цену"""
+        line = self.lines.get(ref_key)
+        if line is None:
+            line = self.lines[ref_key] = CartLine(ref_key, description, price, 0, image)
+        self._total_cents -= _cents(line.subtotal)
+        line.price = price
+        line.quantity += quantity
+        self._total_cents += _cents(line.subtotal)
+        self._text = None
+
+    def remove(self, ref_key):
+        line = self.lines.pop(ref_key, None)
+        if line is not None:
+            self._total_cents -= _cents(line.subtotal)
+            self._text = None
+
+    def set_price(self, ref_key, price):
+        line = self.lines[ref_key]
+        self._total_cents += _cents(price * line.quantity) - _cents(line.subtotal)
+        line.price = price
+        self._text = None
+
+    @property
+    def total(self):
+        return self._total_cents / 100
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(list(self.lines.values()))
+
+    def render(self):
+        """Строки корзины для сообщений; пересобираются только после изменения"""
+        if self._text is None:
+            self._text = "".join(
+                f"▪ {line.description} x{line.quantity} = {line.subtotal:.2f} руб.\n" for line in self.lines.values()
+            )
+        return self._text
+
+    def to_dict(self):
+        # формат прежних корзин-списков: так их читают outbox и хранилища сессий
+        return [
+            {'Ref_Key': line.ref_key, 'Description': line.description, 'Цена': line.price, 'Quantity': line.quantity, 'Изображение': line.image}
+            for line in self.lines.values()
+        ]
+
+    @classmethod
+    def from_dict(cls, items):
+        cart = cls()
+        for item in items or []:
+            cart.add(item['Ref_Key'], item['Description'], item['Цена'], item['Quantity'], item.get('Изображение', ''))
+        return cart
+
+    @classmethod
+    def load(cls, value):
+        """Корзина из хранилища: в памяти лежит сам объект, в SQLite и Redis - to_dict()"""
+        if isinstance(value, cls):
+            return value
+        return cls.from_dict(value)
@@ -0,0 +1,122 @@
+import os
+import time
+import asyncio
+import logging
+import odata_client
+from odata_query import Query, Guid, eq, all_of, any_of
+
+CATALOG_TTL = float(os.getenv('CATALOG_TTL', '300'))
+PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '8'))
+CATEGORY_FIELD = os.getenv('CATALOG_CATEGORY_FIELD', 'Производитель')
+PAGE_FIELDS = ['Ref_Key', 'Description', 'Цена', 'Изображение']
+CATALOG_FIELDS = PAGE_FIELDS + ['Code', 'Описание', 'Масса', 'Производитель', 'СрокГодности']
+if CATEGORY_FIELD not in CATALOG_FIELDS:
+    CATALOG_FIELDS.append(CATEGORY_FIELD)
+
+logger = logging.getLogger(__name__)
+
+_products = []
+_index = {}
+_loaded_at = 0.0
+_lock = asyncio.Lock()
+_refresh_task = None
+
+
+def is_fresh():
+    return bool(_loaded_at) and time.monotonic() - _loaded_at < CATALOG_TTL
+
+
+async def get_products():
+    """Список неудаленных товаров Catalog_Товары из кэша, обновляется раз в CATALOG_TTL секунд"""
+    global _products, _index, _loaded_at
+    if is_fresh():
+        return _products
+    async with _lock:
+        # пока ждали блокировку, каталог мог обновить другой обработчик
+        if is_fresh():
+            return _products
+        products = await odata_client.fetch_all(Query("Catalog_Товары", fields=CATALOG_FIELDS, filter=eq("DeletionMark", False)))
+        _products = products
+        _index = {product['Ref_Key']: product for product in products}
+        _loaded_at = time.monotonic()
+    return _products
+
+
+async def get_product(ref_key):
+    await get_products()
+    return _index.get(ref_key)
+
+
+def lookup(ref_key):
+    """Снимок товара из индекса по Ref_Key без обращения к 1С"""
+    return _index.get(ref_key)
+
+
+def remember(products):
+    for product in products:
+        _index[product['Ref_Key']] = {**_index.get(product['Ref_Key'], {}), **product}
+
+
+async def revalidate(ref_keys):
+    """Актуальные данные товаров корзины одним запросом; удаленные товары пропадают из индекса"""
+    if not ref_keys:
+        return {}
+    products = await odata_client.fetch_all(Query(
+        "Catalog_Товары",
+        fields=PAGE_FIELDS + ['DeletionMark'],
+        filter=any_of(*(eq("Ref_Key", Guid(key)) for key in ref_keys))
+    ))
+    fresh = {product['Ref_Key']: product for product in products if not product.get('DeletionMark')}
+    remember(fresh.values())
+    for key in ref_keys:
+        if key not in fresh:
+            _index.pop(key, None)
+    return fresh
+
+
+async def _refresh():
+    try:
+        await get_products()
+    except Exception as e:
+        logger.error(f"Ошибка фонового обновления каталога: {e}")
+
+
+def _schedule_refresh():
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(_refresh())
+
+
+async def get_categories():
+    products = await get_products()
+    return sorted({str(product[CATEGORY_FIELD]) for product in products if product.get(CATEGORY_FIELD)})
+
+
+async def get_page(page, category=None, page_size=PAGE_SIZE):
+    """Страница каталога (товары, всего): из кэша, а при холодном кэше запросом $top/$skip к 1С"""
+    if is_fresh():
+        products = [p for p in _products if category is None or str(p.get(CATEGORY_FIELD)) == category]
+        return products[page * page_size:(page + 1) * page_size], len(products)
+    # первая клавиатура не ждет загрузки всего каталога, он подгружается в фоне
+    _schedule_refresh()
+    query = Query(
+        "Catalog_Товары",
+        fields=PAGE_FIELDS,
+        filter=all_of(eq("DeletionMark", False), eq(CATEGORY_FIELD, category) if category is not None else None),
+        top=page_size,
+        skip=page * page_size,
+        count=True
+    )
+    data = await odata_client.get(query.path, query.params())
+    products = data.get('value', [])
+    remember(products)
+    total = data.get('odata.count')
+    if total is None:
+        total = page * page_size + len(products) + (1 if len(products) == page_size else 0)
+    return products, int(total)
+
+
+def invalidate():
+    """Сбрасывает кэш, следующее чтение заново загрузит каталог из 1С"""
+    global _loaded_at
+    _loaded_at = 0.0
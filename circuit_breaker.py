@@ -0,0 +1,137 @@
+import os
+import time
+import random
+from collections import deque
+
+WINDOW = int(os.getenv('ODATA_HEALTH_WINDOW', '50'))
+MIN_CALLS = 10
+ERROR_THRESHOLD = float(os.getenv('ODATA_ERROR_THRESHOLD', '0.5'))
+OPEN_SECONDS = float(os.getenv('ODATA_CIRCUIT_OPEN_SECONDS', '30'))
+TIMEOUT_FACTOR = 2.0
+MIN_TIMEOUT = 1.0
+MAX_TIMEOUT = float(os.getenv('ODATA_MAX_TIMEOUT', '30'))
+RETRY_ATTEMPTS = 2
+RETRY_RATIO = 0.1
+RETRY_BASE_DELAY = 0.2
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, endpoint, retry_in):
+        super().__init__(f"{endpoint}: 1С недоступна, повтор через {retry_in:.0f} с")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class EndpointHealth:
+    """Ошибки и задержки одного метода одной сущности 1С за последние WINDOW запросов"""
+
+    def __init__(self, name):
+        self.name = name
+        self.outcomes = deque(maxlen=WINDOW)
+        self.latencies = deque(maxlen=WINDOW)
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def allow(self):
+        if self.state == 'closed':
+            return
+        elapsed = time.monotonic() - self.opened_at
+        if self.state == 'open' and elapsed >= OPEN_SECONDS:
+            self.state = 'half_open'
+            self.probe_in_flight = False
+        # в полуоткрытом состоянии пропускаем один пробный запрос
+        if self.state == 'half_open' and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return
+        raise CircuitOpenError(self.name, max(0.0, OPEN_SECONDS - elapsed))
+
+    def record(self, ok, latency=None):
+        if ok and latency is not None:
+            self.latencies.append(latency)
+        if self.state == 'half_open':
+            self.probe_in_flight = False
+            if ok:
+                self.state = 'closed'
+                self.outcomes.clear()
+            else:
+                self._open()
+            return
+        self.outcomes.append(ok)
+        if len(self.outcomes) >= MIN_CALLS and self.error_rate() >= ERROR_THRESHOLD:
+            self._open()
+
+    def cancel(self):
+        # отмененный пробный запрос не должен навсегда блокировать цепь
+        self.probe_in_flight = False
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def p99(self):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+    def timeout(self, default=None):
+        """Таймаут по наблюдаемому p99 в пределах [MIN_TIMEOUT, MAX_TIMEOUT]: пока 1С отвечает быстро,
+        при ее перезапуске обработчик не ждет полный таймаут. Таймаут вызывающего - значение, пока
+        данных мало, и верхняя граница"""
+        if len(self.latencies) < MIN_CALLS:
+            return default
+        observed = min(max(self.p99() * TIMEOUT_FACTOR, MIN_TIMEOUT), MAX_TIMEOUT)
+        return observed if default is None else min(default, observed)
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'error_rate': round(self.error_rate(), 3),
+            'p99': self.p99(),
+            'timeout': self.timeout(),
+        }
+
+
+class RetryBudget:
+    """Повторы не больше RETRY_RATIO от числа запросов, чтобы не добивать лежащую 1С"""
+
+    def __init__(self, ratio=RETRY_RATIO, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def on_request(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+_endpoints = {}
+retry_budget = RetryBudget()
+
+
+def endpoint(path, method='GET'):
+    # записи и чтения одной сущности живут отдельно: быстрые GET не задают таймаут для POST
+    name = f"{method} {path.split('(')[0].split('?')[0]}"
+    if name not in _endpoints:
+        _endpoints[name] = EndpointHealth(name)
+    return _endpoints[name]
+
+
+def backoff(attempt):
+    # полный джиттер, чтобы повторы разных обработчиков не приходили разом
+    return random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt)
+
+
+def health_stats():
+    return {name: health.stats() for name, health in _endpoints.items()}
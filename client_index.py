@@ -0,0 +1,153 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+import odata_client
+import session_store
+from odata_query import Query, eq, ne, all_of
+
+REFRESH_SECONDS = float(os.getenv('CLIENT_INDEX_REFRESH', '300'))
+MISS_SECONDS = float(os.getenv('CLIENT_INDEX_MISS_TTL', '60'))
+MISS_SIZE = int(os.getenv('CLIENT_INDEX_MISS_SIZE', '10000'))
+# вышедшие через /logout; при SESSION_BACKEND=memory хранятся в отдельном файле, чтобы пережить перезапуск
+LOGOUT_PATH = os.getenv('CLIENT_LOGOUT_PATH', 'logouts.sqlite3')
+LOGOUT_NAMESPACE = 'logged_out'
+CLIENT_FIELDS = ["Ref_Key", "Description", "НомерТелефона", "АдрессДоставки", "telegram_id"]
+
+logger = logging.getLogger(__name__)
+
+# telegram_id -> клиент 1С
+_clients = {}
+# telegram_id -> когда 1С ответила, что такого клиента нет; нужны, только пока индекс устарел
+_misses = OrderedDict()
+_loaded_at = 0.0
+# telegram_id, которые не входят автоматически; None - еще не прочитаны
+_logged_out = None
+_logout_backend = None
+_task = None
+_stats = {'hits': 0, 'lookups': 0, 'loads': 0, 'changed': 0}
+
+
+def _record(client):
+    return {field: client.get(field) for field in CLIENT_FIELDS}
+
+
+def remember(client):
+    """Клиент с telegram_id попадает в индекс сразу, без ожидания следующего обновления"""
+    telegram_id = str(client.get('telegram_id') or '')
+    if not telegram_id:
+        return None
+    _clients[telegram_id] = _record(client)
+    _misses.pop(telegram_id, None)
+    return _clients[telegram_id]
+
+
+async def load():
+    """Все клиенты с telegram_id одним потоковым запросом; в индексе меняются только изменившиеся записи"""
+    global _loaded_at
+    query = Query("Catalog_Клиенты", fields=CLIENT_FIELDS, filter=all_of(eq("DeletionMark", False), ne("telegram_id", "")))
+    seen = set()
+    async for client in odata_client.iter_list(query.path, query.params()):
+        telegram_id = str(client.get('telegram_id') or '')
+        if not telegram_id or telegram_id in seen:
+            continue
+        seen.add(telegram_id)
+        record = _record(client)
+        if _clients.get(telegram_id) != record:
+            _clients[telegram_id] = record
+            _misses.pop(telegram_id, None)
+            _stats['changed'] += 1
+    for telegram_id in set(_clients) - seen:
+        del _clients[telegram_id]
+        _stats['changed'] += 1
+    # свежая полная выгрузка отвечает за всех, прежние отказы больше не нужны
+    _misses.clear()
+    _loaded_at = time.monotonic()
+    _stats['loads'] += 1
+
+
+def _logouts():
+    global _logout_backend
+    if _logout_backend is None:
+        _logout_backend = session_store.backend() if session_store.backend().durable else session_store.SQLiteBackend(LOGOUT_PATH)
+    return _logout_backend
+
+
+async def _ensure_logouts():
+    global _logged_out
+    if _logged_out is None:
+        _logged_out = set(await _logouts().items(LOGOUT_NAMESPACE))
+    return _logged_out
+
+
+async def logout(telegram_id):
+    """После /logout пользователь не входит автоматически, пока снова не пройдет /login или /newclient"""
+    telegram_id = str(telegram_id)
+    (await _ensure_logouts()).add(telegram_id)
+    await _logouts().set_many(LOGOUT_NAMESPACE, {telegram_id: True})
+
+
+async def login(telegram_id):
+    telegram_id = str(telegram_id)
+    logged_out = await _ensure_logouts()
+    if telegram_id in logged_out:
+        logged_out.discard(telegram_id)
+        await _logouts().delete_many(LOGOUT_NAMESPACE, [telegram_id])
+
+
+async def lookup(telegram_id):
+    """Клиент 1С по telegram_id для автоматического входа: из индекса; незнакомых ищем в 1С,
+    только если индекс устарел. Вышедшие через /logout не находятся"""
+    telegram_id = str(telegram_id)
+    if telegram_id in await _ensure_logouts():
+        return None
+    client = _clients.get(telegram_id)
+    if client is not None:
+        _stats['hits'] += 1
+        return client
+    if _loaded_at and time.monotonic() - _loaded_at < REFRESH_SECONDS:
+        return None
+    missed_at = _misses.get(telegram_id)
+    if missed_at is not None and time.monotonic() - missed_at < MISS_SECONDS:
+        return None
+    _stats['lookups'] += 1
+    found = await odata_client.fetch_all(Query(
+        "Catalog_Клиенты",
+        fields=CLIENT_FIELDS,
+        filter=all_of(eq("DeletionMark", False), eq("telegram_id", telegram_id)),
+        top=1
+    ))
+    if not found:
+        _misses[telegram_id] = time.monotonic()
+        _misses.move_to_end(telegram_id)
+        while len(_misses) > MISS_SIZE:
+            _misses.popitem(last=False)
+        return None
+    return remember({**found[0], 'telegram_id': telegram_id})
+
+
+async def _refresh_loop():
+    while True:
+        try:
+            await load()
+        except Exception as e:
+            logger.error(f"Ошибка обновления индекса клиентов: {e}")
+        await asyncio.sleep(REFRESH_SECONDS)
+
+
+def start():
+    global _task
+    _task = asyncio.create_task(_refresh_loop())
+
+
+async def stop():
+    if _task is not None:
+        _task.cancel()
+    # общее хранилище сессий закрывает session_store.close(), здесь - только свой файл
+    if _logout_backend is not None and _logout_backend is not session_store.backend():
+        await _logout_backend.close()
+
+
+def stats():
+    return {'clients': len(_clients), 'misses': len(_misses), 'loaded': bool(_loaded_at), **_stats}
@@ -0,0 +1,26 @@
+import re
+
+# то же правило, что и при вводе номера в боте
+PHONE_PATTERN = re.compile(r'^\+?\d{10,12}$')
+
+
+def is_valid_phone(phone):
+    return bool(PHONE_PATTERN.match(phone or ''))
+
+
+def phone_key(phone):
+    """Последние 10 цифр: +79130000000 и 89130000000 - один и тот же номер"""
+    return re.sub(r'\D', '', phone or '')[-10:]
+
+
+def new_client_payload(name, phone, address, telegram_id=None):
+    """Запись Catalog_Клиенты в формате /newclient"""
+    payload = {
+        "Description": name,
+        "Code": phone[-6:],
+        "НомерТелефона": phone,
+        "АдрессДоставки": address,
+    }
+    if telegram_id is not None:
+        payload["telegram_id"] = str(telegram_id)
+    return payload
@@ -0,0 +1,230 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+import odata_client
+import order_index
+from odata_query import Query, eq, ne, all_of
+
+REFRESH_INTERVAL = float(os.getenv('COURIER_REFRESH_INTERVAL', '60'))
+MAX_LOAD = int(os.getenv('COURIER_MAX_LOAD', '1'))
+SYNC_RETRY_DELAY = 5
+FREE = 'Свободен'
+BUSY = 'Занят'
+
+logger = logging.getLogger(__name__)
+
+_couriers = {}
+# курьер -> заказы с активным назначением (или выданные заказу, который еще пишется в 1С)
+_load = {}
+# заказ -> курьер; заказ еще не записан в 1С
+_reserved = {}
+# заказ -> (курьер, когда записан); нужен, пока 1С не прочитана заново после записи
+_committed = {}
+# с какого момента курьер без заказов: раньше освободился - раньше получит заказ
+_available_since = {}
+# статусы, которые еще нужно отправить в Catalog_Курьеры
+_pending = {}
+_loaded = False
+_load_lock = asyncio.Lock()
+_sync_event = None
+_tasks = []
+
+
+async def load():
+    """Загружает курьеров и их активные назначения из 1С, не затирая локальные резервы и неотправленные статусы"""
+    global _loaded
+    started = time.monotonic()
+    couriers, assignments = await odata_client.read_batch([
+        Query(
+            "Catalog_Курьеры",
+            fields=["Ref_Key", "Description", "Статус"],
+            filter=eq("DeletionMark", False)
+        ),
+        Query(
+            "Document_НазначениеКурьера",
+            fields=["Заказ_Key", "Курьер_Key", "СтатусДоставки", "Заказ/СтатусЗаказа"],
+            filter=all_of(eq("DeletionMark", False), *(ne("СтатусДоставки", status) for status in sorted(order_index.FINAL_STATUSES))),
+            expand="Заказ"
+        ),
+    ])
+    load = {}
+    for assignment in assignments:
+        # то же правило, по которому status_watcher вызывает finish()
+        if order_index.is_final((assignment.get('Заказ') or {}).get('СтатусЗаказа'), assignment.get('СтатусДоставки')):
+            continue
+        load.setdefault(assignment['Курьер_Key'], set()).add(assignment['Заказ_Key'])
+    for order_key, courier_key in _reserved.items():
+        load.setdefault(courier_key, set()).add(order_key)
+    # запись, закончившаяся после начала чтения, в ответ могла не попасть
+    for order_key, (courier_key, committed_at) in list(_committed.items()):
+        load.setdefault(courier_key, set()).add(order_key)
+        if committed_at < started:
+            del _committed[order_key]
+    fresh = {}
+    for courier in couriers:
+        key = courier['Ref_Key']
+        status = courier.get('Статус')
+        if key in _pending:
+            status = _pending[key]
+        elif load.get(key):
+            status = BUSY
+        fresh[key] = {'Ref_Key': key, 'Description': courier.get('Description', 'Неизвестный курьер'), 'Статус': status}
+    _couriers.clear()
+    _couriers.update(fresh)
+    _load.clear()
+    _load.update({key: orders for key, orders in load.items() if key in fresh})
+    for key in fresh:
+        _available_since.setdefault(key, 0.0)
+    _loaded = True
+
+
+async def ensure_loaded():
+    if _loaded:
+        return
+    async with _load_lock:
+        if not _loaded:
+            await load()
+
+
+def _candidates():
+    for key, courier in _couriers.items():
+        load = len(_load.get(key, ()))
+        # занятого в 1С курьера без наших заказов (выходной, занят оператором) не трогаем
+        if load < MAX_LOAD and (courier['Статус'] == FREE or load):
+            yield key, load
+
+
+async def reserve(order_key):
+    """Атомарно выдает заказу наименее загруженного курьера или None; между выбором и выдачей нет await"""
+    return await reserve_many([order_key])
+
+
+async def reserve_many(order_keys):
+    """Один курьер на группу заказов по одному адресу: группа - одна поездка, даже если заказов больше MAX_LOAD"""
+    await ensure_loaded()
+    candidates = list(_candidates())
+    if not candidates:
+        return None
+    key, _ = min(candidates, key=lambda candidate: (candidate[1], _available_since.get(candidate[0], 0.0)))
+    _couriers[key]['Статус'] = BUSY
+    for order_key in order_keys:
+        _load.setdefault(key, set()).add(order_key)
+        _reserved[order_key] = key
+    return dict(_couriers[key])
+
+
+def commit(order_key):
+    """Заказ записан: статус 'Занят' уйдет в 1С фоновой синхронизацией"""
+    courier_key = _reserved.pop(order_key, None)
+    if courier_key is not None:
+        _committed[order_key] = (courier_key, time.monotonic())
+        _schedule_sync(courier_key, BUSY)
+
+
+def release(order_key):
+    """Снимает резерв после сбоя записи заказа; статус в 1С еще не менялся"""
+    courier_key = _reserved.pop(order_key, None)
+    if courier_key is not None:
+        _unload(courier_key, order_key, sync=False)
+
+
+def finish(order_key):
+    """Доставка завершена: курьер освобождается, если у него не осталось заказов"""
+    _committed.pop(order_key, None)
+    for courier_key, orders in list(_load.items()):
+        if order_key in orders and order_key not in _reserved:
+            _unload(courier_key, order_key, sync=True)
+
+
+def _unload(courier_key, order_key, sync):
+    orders = _load.get(courier_key, set())
+    orders.discard(order_key)
+    courier = _couriers.get(courier_key)
+    if orders or courier is None:
+        return
+    courier['Статус'] = FREE
+    _available_since[courier_key] = time.monotonic()
+    if sync:
+        _schedule_sync(courier_key, FREE)
+
+
+def assignment_request(order_key, courier_key, address):
+    """Запись Document_НазначениеКурьера для odata_client.batch"""
+    assignment = {
+        "Ref_Key": str(uuid.uuid4()),
+        "Date": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        "DeletionMark": False,
+        "Posted": True,
+        "Заказ_Key": order_key,
+        "Курьер_Key": courier_key,
+        "СтатусДоставки": "Назначен",
+        "АдресДоставки": address
+    }
+    return ("POST", "Document_НазначениеКурьера", assignment)
+
+
+def _schedule_sync(courier_key, status):
+    _pending[courier_key] = status
+    if _sync_event is not None:
+        _sync_event.set()
+
+
+async def flush():
+    for courier_key, status in list(_pending.items()):
+        await odata_client.patch(f"Catalog_Курьеры(guid'{courier_key}')", {"Статус": status})
+        # пока шел запрос, статус могли поменять еще раз
+        if _pending.get(courier_key) == status:
+            del _pending[courier_key]
+
+
+async def _sync_loop():
+    while True:
+        await _sync_event.wait()
+        _sync_event.clear()
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации статусов курьеров: {e}")
+            await asyncio.sleep(SYNC_RETRY_DELAY)
+            _sync_event.set()
+
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            await load()
+        except Exception as e:
+            logger.error(f"Ошибка обновления списка курьеров: {e}")
+
+
+def start():
+    global _sync_event
+    _sync_event = asyncio.Event()
+    if _pending:
+        _sync_event.set()
+    _tasks.append(asyncio.create_task(_sync_loop()))
+    _tasks.append(asyncio.create_task(_refresh_loop()))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    _tasks.clear()
+    try:
+        await flush()
+    except Exception as e:
+        logger.error(f"Не удалось отправить статусы курьеров: {e}")
+
+
+def pool_stats():
+    return {
+        'total': len(_couriers),
+        'free': sum(1 for key, courier in _couriers.items() if courier['Статус'] == FREE and not _load.get(key)),
+        'active': sum(len(orders) for orders in _load.values()),
+        'reserved': len(_reserved),
+        'pending_sync': len(_pending),
+    }
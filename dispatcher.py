@@ -0,0 +1,219 @@
+import os
+import re
+import asyncio
+import contextlib
+import logging
+import odata_client
+import courier_pool
+from odata_query import Query, Guid, eq, all_of
+
+# 0 - курьер назначается сразу при записи заказа
+DISPATCH_WINDOW = float(os.getenv('DISPATCH_WINDOW', '0'))
+EMPTY_KEY = '00000000-0000-0000-0000-000000000000'
+# после стольких отказов 1С заказ остается без курьера, клиенту уходит сообщение
+MAX_REJECTIONS = 3
+ADDRESS_TAIL = re.compile(r'\b(?:кв|квартира|оф|офис|подъезд|под|эт|этаж|домофон)\b.*$')
+
+logger = logging.getLogger(__name__)
+
+# заказ -> адрес; записаны в 1С и ждут курьера
+_pending = {}
+# заказ -> (user_id, номер) для сообщения, если курьера так и не удалось назначить
+_owners = {}
+# заказ -> сколько раз 1С отклонила его назначение
+_rejections = {}
+_notify = None
+_event = None
+_task = None
+_stats = {'windows': 0, 'orders': 0, 'groups': 0, 'writes': 0, 'deferred': 0, 'rejected': 0}
+
+
+def enabled():
+    return DISPATCH_WINDOW > 0
+
+
+def normalize_address(address):
+    """Адрес без квартиры, этажа и знаков препинания: заказы в один дом попадают в одну группу"""
+    text = (address or '').lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    text = ADDRESS_TAIL.sub('', text)
+    return ' '.join(text.split())
+
+
+def submit(order_key, address, user_id=None, number=None):
+    """Заказ записан без курьера; назначение уйдет с ближайшим окном"""
+    _pending[order_key] = address
+    if user_id is not None:
+        _owners[order_key] = (user_id, number)
+    if _event is not None:
+        _event.set()
+
+
+async def load_unassigned():
+    """Новые заказы без курьера, оставшиеся от прошлого запуска"""
+    orders = await odata_client.fetch_all(Query(
+        "Document_ЗаказКлиента",
+        fields=["Ref_Key", "АдресДоставки"],
+        filter=all_of(eq("DeletionMark", False), eq("СтатусЗаказа", "Новый"), eq("Курьер_Key", Guid(EMPTY_KEY)))
+    ))
+    for order in orders:
+        _pending.setdefault(order['Ref_Key'], order.get('АдресДоставки'))
+
+
+def _writes(group, courier_key):
+    writes = []
+    for order_key, address in group:
+        writes.append(courier_pool.assignment_request(order_key, courier_key, address))
+        writes.append(("PATCH", f"Document_ЗаказКлиента(guid'{order_key}')", {"Курьер_Key": courier_key, "СтатусЗаказа": "В обработке"}))
+    return writes
+
+
+def _done(group):
+    for order_key, _ in group:
+        courier_pool.commit(order_key)
+        _owners.pop(order_key, None)
+        _rejections.pop(order_key, None)
+    _stats['orders'] += len(group)
+
+
+def _requeue(group):
+    for order_key, _ in group:
+        courier_pool.release(order_key)
+    _pending.update(group)
+
+
+async def _rejected(group, error):
+    """1С отклонила назначения группы: несколько окон пробуем снова, потом сообщаем клиенту"""
+    for order_key, address in group:
+        courier_pool.release(order_key)
+        _rejections[order_key] = _rejections.get(order_key, 0) + 1
+        if _rejections[order_key] < MAX_REJECTIONS:
+            _pending[order_key] = address
+            continue
+        _rejections.pop(order_key)
+        _stats['rejected'] += 1
+        logger.error(f"Курьер не назначен заказу {order_key}, 1С отклоняет назначение: {error}")
+        owner = _owners.pop(order_key, None)
+        if owner is not None and _notify is not None:
+            user_id, number = owner
+            try:
+                await _notify(user_id, f"⚠️ Не удалось назначить курьера на заказ №{number or ''}. С вами свяжется оператор.")
+            except Exception as e:
+                logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+
+
+async def _write_groups(reserved):
+    """Назначения по одной группе: отклоненная запись откатывает только свою группу"""
+    for index, (group, courier_key) in enumerate(reserved):
+        try:
+            await odata_client.batch(_writes(group, courier_key))
+        except asyncio.CancelledError:
+            for rest, _ in reserved[index:]:
+                _requeue(rest)
+            raise
+        except Exception as e:
+            if odata_client.is_transient_error(e):
+                _requeue(group)
+            else:
+                await _rejected(group, e)
+            continue
+        _done(group)
+        _stats['writes'] += 1
+
+
+async def dispatch():
+    """Один проход: группы заказов по адресу, по курьеру на группу, все назначения одним $batch"""
+    groups = {}
+    for order_key, address in _pending.items():
+        groups.setdefault(normalize_address(address), []).append((order_key, address))
+    _pending.clear()
+    # (группа, курьер)
+    reserved = []
+    waiting = sorted(groups.values(), key=len, reverse=True)
+    writes = []
+    try:
+        # крупные группы первыми: при нехватке курьеров ждать остаются одиночные заказы
+        while waiting:
+            group = waiting[0]
+            courier = await courier_pool.reserve_many([order_key for order_key, _ in group])
+            waiting.pop(0)
+            if courier is None:
+                _pending.update(group)
+                continue
+            reserved.append((group, courier['Ref_Key']))
+            writes += _writes(group, courier['Ref_Key'])
+            _stats['groups'] += 1
+        _stats['windows'] += 1
+        _stats['deferred'] += len(_pending)
+        if not writes:
+            return
+        await odata_client.batch(writes)
+    except asyncio.CancelledError:
+        # остановка посреди окна: заказы и резервы не теряются, их допишет stop()
+        for group in waiting:
+            _pending.update(group)
+        for group, _ in reserved:
+            _requeue(group)
+        raise
+    except Exception as e:
+        for group in waiting:
+            _pending.update(group)
+        if odata_client.is_transient_error(e) or not reserved:
+            for group, _ in reserved:
+                _requeue(group)
+            raise
+        if len(reserved) == 1:
+            await _rejected(reserved[0][0], e)
+            return
+        # changeset атомарен: одна отклоненная запись откатила все группы, пишем их по отдельности
+        logger.warning(f"Пакет назначений отклонен 1С, группы пишутся по одной: {e}")
+        await _write_groups(reserved)
+        return
+    for group, _ in reserved:
+        _done(group)
+    _stats['writes'] += 1
+
+
+async def _dispatch_loop():
+    try:
+        await load_unassigned()
+    except Exception as e:
+        logger.error(f"Не удалось загрузить заказы без курьера: {e}")
+    while True:
+        if not _pending:
+            await _event.wait()
+        _event.clear()
+        await asyncio.sleep(DISPATCH_WINDOW)
+        try:
+            await dispatch()
+        except Exception as e:
+            logger.error(f"Ошибка пакетного назначения курьеров: {e}")
+
+
+def start(notify=None):
+    """notify(user_id, text) сообщает клиенту, что курьера назначить не удалось"""
+    global _notify, _event, _task
+    if not enabled():
+        return
+    _notify = notify
+    _event = asyncio.Event()
+    _task = asyncio.create_task(_dispatch_loop())
+
+
+async def stop():
+    if _task is None:
+        return
+    _task.cancel()
+    # прерванное окно возвращает заказы в _pending и снимает резервы
+    with contextlib.suppress(asyncio.CancelledError):
+        await _task
+    # принятые заказы не должны ждать следующего запуска
+    if _pending:
+        try:
+            await dispatch()
+        except Exception as e:
+            logger.error(f"Не назначены курьеры при остановке: {e}")
+
+
+def stats():
+    return {'window': DISPATCH_WINDOW, 'pending': len(_pending), **_stats}
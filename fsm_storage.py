@@ -0,0 +1,57 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+import session_store
+
+
+class StoreStorage(BaseStorage):
+    """Состояния FSM в хранилище сессий (SQLite или Redis): оформление заказа переживает перезапуск
+    и продолжается в любом процессе бота. Частые update_data одного обработчика уходят одной записью"""
+
+    def __init__(self, namespace='fsm'):
+        self._store = session_store.Store(namespace)
+
+    @staticmethod
+    def _key(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    async def _get(self, key):
+        return await self._store.get(self._key(key)) or {'state': None, 'data': {}}
+
+    def _put(self, key, record):
+        if record['state'] is None and not record['data']:
+            self._store.delete(self._key(key))
+        else:
+            self._store.set(self._key(key), record)
+
+    async def set_state(self, key, state=None):
+        record = await self._get(key)
+        record['state'] = state.state if isinstance(state, State) else state
+        self._put(key, record)
+
+    async def get_state(self, key):
+        return (await self._get(key))['state']
+
+    async def set_data(self, key, data):
+        record = await self._get(key)
+        record['data'] = dict(data)
+        self._put(key, record)
+
+    async def get_data(self, key):
+        return dict((await self._get(key))['data'])
+
+    async def update_data(self, key, data):
+        record = await self._get(key)
+        record['data'] = {**record['data'], **data}
+        self._put(key, record)
+        return dict(record['data'])
+
+    async def close(self):
+        await self._store.flush()
+
+
+def create():
+    """Хранилище FSM для Dispatcher: при SESSION_BACKEND=memory - обычное в памяти"""
+    if not session_store.backend().durable:
+        return MemoryStorage()
+    return StoreStorage()
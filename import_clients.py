@@ -0,0 +1,179 @@
+"""Массовый импорт клиентов в Catalog_Клиенты из CSV или JSONL.
+
+Колонки: name, phone, address, telegram_id (или Description, НомерТелефона, АдрессДоставки).
+Клиенты с уже известным номером телефона пропускаются, поэтому импорт можно безопасно перезапускать.
+
+    python import_clients.py partners.csv --concurrency 8 --batch-size 20 --failed failed.jsonl
+"""
+import os
+import csv
+import json
+import time
+import asyncio
+import argparse
+import odata_client
+import clients
+from odata_query import Query
+
+CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', '8'))
+BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '20'))
+SHOWN_FAILURES = 20
+
+
+def read_rows(path):
+    """Строки файла по одной: (номер строки, запись или None, если строка не разбирается)"""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith(('.jsonl', '.ndjson')):
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield number, json.loads(line)
+                except json.JSONDecodeError:
+                    yield number, None
+        else:
+            # первая строка CSV - заголовок
+            for number, row in enumerate(csv.DictReader(f), start=2):
+                yield number, row
+
+
+def _field(row, *names):
+    for name in names:
+        value = row.get(name)
+        if value not in (None, ''):
+            return str(value).strip()
+    return ''
+
+
+def to_payload(row):
+    """(запись Catalog_Клиенты, None) или (None, причина отказа)"""
+    if not isinstance(row, dict):
+        return None, "строка не разбирается"
+    name = _field(row, 'name', 'Description')
+    phone = _field(row, 'phone', 'НомерТелефона')
+    address = _field(row, 'address', 'АдрессДоставки')
+    if not name:
+        return None, "не указано имя"
+    if not clients.is_valid_phone(phone):
+        return None, f"неверный формат номера телефона: {phone}"
+    telegram_id = _field(row, 'telegram_id') or None
+    return clients.new_client_payload(name, phone, address, telegram_id), None
+
+
+async def existing_phones():
+    """Номера всех клиентов 1С одним потоковым запросом"""
+    query = Query("Catalog_Клиенты", fields=["НомерТелефона"])
+    phones = set()
+    async for client in odata_client.iter_list(query.path, query.params()):
+        if client.get('НомерТелефона'):
+            phones.add(clients.phone_key(client['НомерТелефона']))
+    return phones
+
+
+def _error_text(e):
+    return e.text if isinstance(e, odata_client.ODataError) else str(e)
+
+
+async def _write_chunk(chunk, report):
+    try:
+        await odata_client.batch([("POST", "Catalog_Клиенты", payload) for _, payload in chunk])
+        report['imported'] += len(chunk)
+        return
+    except Exception as e:
+        error = e
+    # без $batch записи шли по одной: созданные до ошибки клиенты уже в 1С и повторно не отправляются
+    completed = getattr(error, 'completed', None)
+    rest = chunk
+    if completed is not None:
+        report['imported'] += completed
+        number, payload = chunk[completed]
+        report['failed'].append((number, payload, _error_text(error)))
+        rest = chunk[completed + 1:]
+    if odata_client.is_transient_error(error):
+        report['failed'] += [(number, payload, _error_text(error)) for number, payload in rest]
+        return
+    # changeset атомарен: одна отклоненная запись откатывает весь пакет, поэтому повторяем по одной
+    for number, payload in rest:
+        try:
+            await odata_client.post("Catalog_Клиенты", payload)
+            report['imported'] += 1
+        except Exception as e:
+            report['failed'].append((number, payload, _error_text(e)))
+
+
+async def _writer(queue, report):
+    while True:
+        chunk = await queue.get()
+        if chunk is None:
+            return
+        await _write_chunk(chunk, report)
+
+
+async def import_clients(path, concurrency=CONCURRENCY, batch_size=BATCH_SIZE):
+    report = {'rows': 0, 'imported': 0, 'duplicates': 0, 'invalid': [], 'failed': []}
+    started = time.monotonic()
+    known = await existing_phones()
+    # очередь ограничена, чтобы файл читался не быстрее, чем идет запись в 1С
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    writers = [asyncio.create_task(_writer(queue, report)) for _ in range(concurrency)]
+    chunk = []
+    for number, row in read_rows(path):
+        report['rows'] += 1
+        payload, error = to_payload(row)
+        if error:
+            report['invalid'].append((number, row, error))
+            continue
+        key = clients.phone_key(payload['НомерТелефона'])
+        if key in known:
+            report['duplicates'] += 1
+            continue
+        known.add(key)
+        chunk.append((number, payload))
+        if len(chunk) >= batch_size:
+            await queue.put(chunk)
+            chunk = []
+    if chunk:
+        await queue.put(chunk)
+    for _ in writers:
+        await queue.put(None)
+    await asyncio.gather(*writers)
+    report['elapsed'] = time.monotonic() - started
+    return report
+
+
+def print_report(report, failed_path=None):
+    failures = sorted(report['invalid'] + report['failed'], key=lambda failure: failure[0])
+    elapsed = report['elapsed']
+    print(
+        f"📥 Строк: {report['rows']}, импортировано: {report['imported']}, "
+        f"дубликатов: {report['duplicates']}, с ошибками: {len(failures)}"
+    )
+    print(f"⏱ {elapsed:.1f} с, {report['rows'] / elapsed if elapsed else 0:.1f} строк/с, {report['imported'] / elapsed if elapsed else 0:.1f} записей/с")
+    for number, _, error in failures[:SHOWN_FAILURES]:
+        print(f"❌ Строка {number}: {error}")
+    if len(failures) > SHOWN_FAILURES:
+        print(f"... и еще {len(failures) - SHOWN_FAILURES}")
+    if failed_path and failures:
+        with open(failed_path, 'w', encoding='utf-8') as f:
+            for number, row, error in failures:
+                f.write(json.dumps({'line': number, 'error': error, 'row': row}, ensure_ascii=False) + "\n")
+        print(f"📝 Строки с ошибками сохранены в {failed_path}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Импорт клиентов в 1С из CSV или JSONL")
+    parser.add_argument('path')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="одновременных запросов к 1С")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="клиентов в одном $batch")
+    parser.add_argument('--failed', help="куда сохранить строки с ошибками (JSONL)")
+    args = parser.parse_args()
+    try:
+        report = await import_clients(args.path, args.concurrency, args.batch_size)
+        print_report(report, args.failed)
+        print(f"🔌 Пул соединений: {odata_client.pool_stats()}")
+    finally:
+        await odata_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,521 @@
+import os
+import json
+import time
+import uuid
+import codecs
+import asyncio
+import contextlib
+import logging
+import aiohttp
+from yarl import URL
+from dotenv import load_dotenv
+import circuit_breaker
+
+load_dotenv()
+ODATA_URL = os.getenv('ODATA_URL', 'http://localhost/proekt/odata/standard.odata/')
+POOL_LIMIT = int(os.getenv('ODATA_POOL_SIZE', '200'))
+POOL_LIMIT_PER_HOST = int(os.getenv('ODATA_POOL_PER_HOST', '100'))
+KEEPALIVE_TIMEOUT = float(os.getenv('ODATA_KEEPALIVE', '30'))
+BATCH_ENABLED = os.getenv('ODATA_BATCH', '1') == '1'
+
+JSON_HEADERS = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'application/json'}
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_sync_loop = None
+_stats = {
+    'requests': 0,
+    'in_flight': 0,
+    'peak_in_flight': 0,
+    'connections_created': 0,
+    'connections_reused': 0,
+}
+_INCOMPLETE = object()
+# None - еще не проверяли, поддерживает ли 1С $batch
+_batch_supported = None
+_in_flight_gets = {}
+_coalesce_stats = {}
+
+
+class ODataError(Exception):
+    def __init__(self, status, text):
+        super().__init__(f"HTTP {status}: {text}")
+        self.status = status
+        self.text = text
+
+
+async def _on_connection_create(session, context, params):
+    _stats['connections_created'] += 1
+
+
+async def _on_connection_reuse(session, context, params):
+    _stats['connections_reused'] += 1
+
+
+def get_session():
+    """Общая сессия aiohttp с пулом keep-alive соединений к 1С"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(_on_connection_create)
+        trace_config.on_connection_reuseconn.append(_on_connection_reuse)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'Accept': 'application/json'},
+            trace_configs=[trace_config]
+        )
+    return _session
+
+
+def pool_stats():
+    """Статистика пула соединений для подбора его размера"""
+    return {
+        'limit': POOL_LIMIT,
+        'limit_per_host': POOL_LIMIT_PER_HOST,
+        'keepalive_timeout': KEEPALIVE_TIMEOUT,
+        **_stats,
+    }
+
+
+def coalesce_stats():
+    """По сущностям: сколько GET запрошено, сколько ушло в 1С и сколько сэкономлено объединением"""
+    return {endpoint: dict(counters) for endpoint, counters in _coalesce_stats.items()}
+
+
+def run_sync(coro):
+    """Выполняет корутину клиента из синхронного кода (отчеты), сохраняя пул между вызовами"""
+    global _sync_loop
+    if _sync_loop is None or _sync_loop.is_closed():
+        _sync_loop = asyncio.new_event_loop()
+    return _sync_loop.run_until_complete(coro)
+
+
+async def close():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+@contextlib.contextmanager
+def _tracked():
+    _stats['requests'] += 1
+    _stats['in_flight'] += 1
+    _stats['peak_in_flight'] = max(_stats['peak_in_flight'], _stats['in_flight'])
+    try:
+        yield
+    finally:
+        _stats['in_flight'] -= 1
+
+
+def _url(path):
+    return path if path.startswith('http') else f"{ODATA_URL}{path}"
+
+
+def decode_body(raw):
+    # 1С отдает JSON с UTF-8 BOM
+    if not raw:
+        return {}
+    return json.loads(raw.decode('utf-8-sig'))
+
+
+def is_transient_error(error):
+    """Сбой связи или сервера 1С, после которого запрос имеет смысл повторить.
+    4xx - ошибка самого запроса, а не признак того, что 1С лежит"""
+    if isinstance(error, ODataError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, circuit_breaker.CircuitOpenError))
+
+
+async def _send(method, path, params, data, headers, timeout, expected):
+    with _tracked():
+        async with get_session().request(
+            method, _url(path), params=params, json=data, headers=headers,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            raw = await response.read()
+            if response.status not in expected:
+                raise ODataError(response.status, raw.decode('utf-8-sig', errors='replace'))
+            return decode_body(raw)
+
+
+async def request(method, path, params=None, data=None, headers=None, timeout=10, expected=(200,)):
+    """Запрос к 1С через автомат размыкания цепи; идемпотентные GET повторяются в пределах бюджета"""
+    health = circuit_breaker.endpoint(path, method)
+    circuit_breaker.retry_budget.on_request()
+    attempt = 0
+    while True:
+        health.allow()
+        started = time.monotonic()
+        try:
+            result = await _send(method, path, params, data, headers, health.timeout(timeout), expected)
+        except asyncio.CancelledError:
+            health.cancel()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, ODataError) as e:
+            failed = is_transient_error(e)
+            health.record(not failed)
+            if (not failed or method != 'GET' or attempt >= circuit_breaker.RETRY_ATTEMPTS
+                    or not circuit_breaker.retry_budget.try_spend()):
+                raise
+            attempt += 1
+            logger.warning(f"Повтор {attempt} запроса {path}: {e}")
+            await asyncio.sleep(circuit_breaker.backoff(attempt))
+            continue
+        except Exception:
+            # например, не-JSON ответ 200: пробный запрос полуоткрытой цепи должен завершиться
+            health.record(False)
+            raise
+        health.record(True, time.monotonic() - started)
+        return result
+
+
+def _forget_get(key, future):
+    if _in_flight_gets.get(key) is future:
+        del _in_flight_gets[key]
+    if not future.cancelled():
+        # ошибку уже получили ожидающие, здесь только гасим предупреждение asyncio
+        future.exception()
+
+
+async def get(path, params=None, timeout=10):
+    """GET с объединением одинаковых одновременных запросов: в 1С уходит один, результат общий.
+    Результат может достаться нескольким обработчикам, изменять его нельзя"""
+    key = (path, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items())))
+    counters = _coalesce_stats.setdefault(path.split('(')[0], {'calls': 0, 'upstream': 0, 'saved': 0})
+    counters['calls'] += 1
+    future = _in_flight_gets.get(key)
+    if future is None:
+        counters['upstream'] += 1
+        future = asyncio.ensure_future(request('GET', path, params=params, timeout=timeout))
+        _in_flight_gets[key] = future
+        future.add_done_callback(lambda f: _forget_get(key, f))
+    else:
+        counters['saved'] += 1
+    # shield: отмена одного ожидающего не должна обрывать запрос остальным
+    return await asyncio.shield(future)
+
+
+async def get_list(path, params=None, timeout=10):
+    return (await get(path, params=params, timeout=timeout)).get('value', [])
+
+
+async def fetch_all(query, timeout=10):
+    return await get_list(query.path, query.params(), timeout=timeout)
+
+
+async def fetch_one(query, timeout=10):
+    return await get(query.path, query.params(), timeout=timeout)
+
+
+async def post(path, data, headers=None, timeout=10):
+    return await request('POST', path, data=data, headers={**JSON_HEADERS, **(headers or {})}, timeout=timeout, expected=(200, 201))
+
+
+async def patch(path, data, headers=None, timeout=10):
+    return await request('PATCH', path, data=data, headers={**JSON_HEADERS, **(headers or {})}, timeout=timeout, expected=(200, 204))
+
+
+def _build_changeset(requests):
+    batch_boundary = f"batch_{uuid.uuid4()}"
+    changeset_boundary = f"changeset_{uuid.uuid4()}"
+    lines = [
+        f"--{batch_boundary}",
+        f"Content-Type: multipart/mixed; boundary={changeset_boundary}",
+        "",
+    ]
+    for content_id, (method, path, data) in enumerate(requests, start=1):
+        lines += [
+            f"--{changeset_boundary}",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            f"Content-ID: {content_id}",
+            "",
+            f"{method} {URL(_url(path))} HTTP/1.1",
+            "Content-Type: application/json; charset=utf-8",
+            "Accept: application/json",
+            "Prefer: return=representation",
+            "",
+            json.dumps(data, ensure_ascii=False),
+        ]
+    lines += [f"--{changeset_boundary}--", f"--{batch_boundary}--", ""]
+    return batch_boundary, "\r\n".join(lines).encode('utf-8')
+
+
+def _boundary(content_type):
+    for part in content_type.split(';'):
+        name, _, value = part.strip().partition('=')
+        if name.lower() == 'boundary':
+            return value.strip('"')
+    raise ValueError(f"Нет boundary в {content_type}")
+
+
+def _split_head(raw):
+    head, sep, body = raw.partition(b'\r\n\r\n')
+    if not sep:
+        head, sep, body = raw.partition(b'\n\n')
+    headers = {}
+    lines = head.decode('utf-8', errors='replace').splitlines()
+    for line in lines:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return lines, headers, body
+
+
+def _parse_multipart(raw, boundary):
+    """Ответы (статус, тело) из multipart-ответа $batch, вложенные changeset разворачиваются"""
+    results = []
+    delimiter = f"--{boundary}".encode()
+    for part in raw.split(delimiter)[1:]:
+        if part.startswith(b'--'):
+            break
+        lines, headers, body = _split_head(part.strip(b'\r\n'))
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('multipart/mixed'):
+            results += _parse_multipart(body, _boundary(content_type))
+            continue
+        status_lines, _, payload = _split_head(body)
+        status = int(status_lines[0].split()[1])
+        results.append((status, payload.rstrip(b'\r\n')))
+    return results
+
+
+async def _run_sequential(requests, timeout):
+    """Записи по одной; в отличие от changeset не атомарны: у ошибки в completed - сколько записей
+    до нее уже выполнено"""
+    results = []
+    try:
+        for method, path, data in requests:
+            if method == 'POST':
+                results.append(await post(path, data, headers={'Prefer': 'return=representation'}, timeout=timeout))
+            else:
+                results.append(await request(method, path, data=data, headers=JSON_HEADERS, timeout=timeout, expected=(200, 201, 204)))
+    except Exception as e:
+        e.completed = len(results)
+        raise
+    return results
+
+
+async def _send_batch(boundary, body, timeout, method):
+    # method - что внутри пакета: GET для чтений, POST для changeset с записями
+    health = circuit_breaker.endpoint('$batch', method)
+    health.allow()
+    started = time.monotonic()
+    try:
+        with _tracked():
+            async with get_session().post(
+                _url('$batch'), data=body,
+                headers={'Content-Type': f"multipart/mixed; boundary={boundary}", 'Accept': 'multipart/mixed'},
+                timeout=aiohttp.ClientTimeout(total=health.timeout(timeout))
+            ) as response:
+                raw = await response.read()
+                content_type = response.headers.get('Content-Type', '')
+                status = response.status
+    except asyncio.CancelledError:
+        health.cancel()
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        health.record(False)
+        raise
+    health.record(status < 500, time.monotonic() - started)
+    return status, content_type, raw
+
+
+def _batch_rejected(status):
+    global _batch_supported
+    if status in (400, 404, 405, 501) and _batch_supported is None:
+        logger.warning(f"1С не поддерживает $batch (HTTP {status}), запросы пойдут по одному")
+        _batch_supported = False
+        return True
+    return False
+
+
+def _batch_results(status, content_type, raw, expected_count):
+    global _batch_supported
+    if status not in (200, 202) or not content_type.startswith('multipart/mixed'):
+        raise ODataError(status, raw.decode('utf-8-sig', errors='replace'))
+    _batch_supported = True
+    results = []
+    for part_status, payload in _parse_multipart(raw, _boundary(content_type)):
+        if part_status >= 400:
+            raise ODataError(part_status, payload.decode('utf-8-sig', errors='replace'))
+        results.append(decode_body(payload))
+    if len(results) != expected_count:
+        raise ODataError(status, f"Ожидалось {expected_count} ответов в $batch, получено {len(results)}")
+    return results
+
+
+async def batch(requests, timeout=15):
+    """Выполняет записи [(метод, путь, данные), ...] одним атомарным changeset через $batch.
+    Если 1С не поддерживает $batch, записи уходят последовательно, и у ошибки есть completed"""
+    if not BATCH_ENABLED or _batch_supported is False:
+        return await _run_sequential(requests, timeout)
+    boundary, body = _build_changeset(requests)
+    status, content_type, raw = await _send_batch(boundary, body, timeout, 'POST')
+    # на отказ от $batch сервер отвечает до выполнения записей, поэтому повтор безопасен
+    if _batch_rejected(status):
+        return await _run_sequential(requests, timeout)
+    return _batch_results(status, content_type, raw, len(requests))
+
+
+def _build_read_batch(queries):
+    batch_boundary = f"batch_{uuid.uuid4()}"
+    lines = []
+    for query in queries:
+        url = URL(_url(query.path)).update_query({k: str(v) for k, v in query.params().items()})
+        lines += [
+            f"--{batch_boundary}",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            "",
+            f"GET {url} HTTP/1.1",
+            "Accept: application/json",
+            "",
+        ]
+    lines += [f"--{batch_boundary}--", ""]
+    return batch_boundary, "\r\n".join(lines).encode('utf-8')
+
+
+def _unwrap(query, result):
+    return result if query.key is not None else result.get('value', [])
+
+
+async def read_batch(queries, timeout=15):
+    """Несколько Query одним запросом $batch; для коллекций возвращает списки, для ключей - сущности.
+    Если 1С не поддерживает $batch, запросы уходят параллельно"""
+    if not BATCH_ENABLED or _batch_supported is False:
+        results = await asyncio.gather(*(fetch_one(query, timeout=timeout) for query in queries))
+        return [_unwrap(query, result) for query, result in zip(queries, results)]
+    boundary, body = _build_read_batch(queries)
+    status, content_type, raw = await _send_batch(boundary, body, timeout, 'GET')
+    if _batch_rejected(status):
+        return await read_batch(queries, timeout)
+    results = _batch_results(status, content_type, raw, len(queries))
+    return [_unwrap(query, result) for query, result in zip(queries, results)]
+
+
+class _ValueStream:
+    """Инкрементальный разбор ответа {"odata.metadata": ..., "value": [...]} по одной строке"""
+
+    def __init__(self):
+        self.buf = ''
+        self.state = 'start'
+        self.key = None
+        self.decoder = json.JSONDecoder()
+
+    def _decode(self, pos, final):
+        try:
+            obj, end = self.decoder.raw_decode(self.buf, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return _INCOMPLETE, pos
+        # число в конце буфера может продолжиться в следующем чанке
+        if end >= len(self.buf) and not final:
+            return _INCOMPLETE, pos
+        return obj, end
+
+    def feed(self, text, final=False):
+        self.buf += text
+        rows = []
+        pos = 0
+        while True:
+            while pos < len(self.buf) and self.buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos >= len(self.buf):
+                break
+            ch = self.buf[pos]
+            if self.state == 'start':
+                if ch != '{':
+                    raise ValueError("Ожидался JSON-объект")
+                pos += 1
+                self.state = 'key'
+            elif self.state == 'key':
+                if ch == '}':
+                    pos += 1
+                    self.state = 'done'
+                    continue
+                if ch == ',':
+                    pos += 1
+                    continue
+                key, end = self._decode(pos, final)
+                if key is _INCOMPLETE:
+                    break
+                pos = end
+                self.key = key
+                self.state = 'colon'
+            elif self.state == 'colon':
+                if ch != ':':
+                    raise ValueError("Ожидалось ':' после ключа")
+                pos += 1
+                self.state = 'array' if self.key == 'value' else 'skip'
+            elif self.state == 'skip':
+                value, end = self._decode(pos, final)
+                if value is _INCOMPLETE:
+                    break
+                pos = end
+                self.state = 'key'
+            elif self.state == 'array':
+                if ch != '[':
+                    raise ValueError("Поле value должно быть массивом")
+                pos += 1
+                self.state = 'items'
+            elif self.state == 'items':
+                if ch == ']':
+                    pos += 1
+                    self.state = 'key'
+                    continue
+                if ch == ',':
+                    pos += 1
+                    continue
+                row, end = self._decode(pos, final)
+                if row is _INCOMPLETE:
+                    break
+                pos = end
+                rows.append(row)
+            else:
+                raise ValueError("Лишние данные после JSON")
+        self.buf = self.buf[pos:]
+        if final and self.state != 'done':
+            raise ValueError("Ответ 1С оборвался")
+        return rows
+
+
+async def iter_list(path, params=None, timeout=120, chunk_size=65536, connect_timeout=10):
+    """Потоковое чтение коллекции: строки value отдаются по одной, весь ответ в памяти не держится.
+    timeout - сколько ждать очередную порцию данных; общего ограничения нет, большая выгрузка
+    идет столько, сколько нужно, пока 1С продолжает отдавать данные"""
+    health = circuit_breaker.endpoint(path)
+    health.allow()
+    with _tracked():
+        try:
+            response = await get_session().get(
+                _url(path), params=params,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=timeout)
+            )
+        except asyncio.CancelledError:
+            health.cancel()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            health.record(False)
+            raise
+        async with response:
+            health.record(response.status < 500)
+            if response.status != 200:
+                raw = await response.read()
+                raise ODataError(response.status, raw.decode('utf-8-sig', errors='replace'))
+            # utf-8-sig снимает BOM с первых байтов потока
+            decoder = codecs.getincrementaldecoder('utf-8-sig')()
+            parser = _ValueStream()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                for row in parser.feed(decoder.decode(chunk)):
+                    yield row
+            for row in parser.feed(decoder.decode(b'', final=True), final=True):
+                yield row
@@ -0,0 +1,84 @@
+from datetime import datetime
+
+
+class Guid(str):
+    """Ключ ссылки 1С, в фильтре записывается как guid'...'"""
+
+
+def literal(value):
+    """Литерал OData для подстановки в $filter или ключ сущности"""
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, Guid):
+        return f"guid'{value}'"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, datetime):
+        return f"datetime'{value.strftime('%Y-%m-%dT%H:%M:%S')}'"
+    text = str(value).replace("'", "''")
+    return f"'{text}'"
+
+
+def eq(field, value):
+    return f"{field} eq {literal(value)}"
+
+
+def ne(field, value):
+    return f"{field} ne {literal(value)}"
+
+
+def gt(field, value):
+    return f"{field} gt {literal(value)}"
+
+
+def ge(field, value):
+    return f"{field} ge {literal(value)}"
+
+
+def all_of(*conditions):
+    return " and ".join(c for c in conditions if c)
+
+
+def any_of(*conditions):
+    return "(" + " or ".join(conditions) + ")"
+
+
+class Query:
+    """Запрос к сущности 1С; $select строится всегда, чтобы не тянуть реквизиты, которые не нужны"""
+
+    def __init__(self, entity, fields, filter=None, order=None, top=None, skip=None, expand=None, key=None, count=False):
+        if not fields:
+            raise ValueError(f"Не указаны поля для {entity}")
+        self.entity = entity
+        self.fields = list(fields)
+        self.filter = filter
+        self.order = order
+        self.top = top
+        self.skip = skip
+        self.expand = expand
+        self.key = key
+        self.count = count
+
+    @property
+    def path(self):
+        if self.key is None:
+            return self.entity
+        return f"{self.entity}({literal(Guid(self.key))})"
+
+    def params(self):
+        params = {"$select": ",".join(self.fields), "$format": "json"}
+        if self.filter:
+            params["$filter"] = self.filter
+        if self.order:
+            params["$orderby"] = self.order
+        if self.top is not None:
+            params["$top"] = self.top
+        if self.skip:
+            params["$skip"] = self.skip
+        if self.expand:
+            params["$expand"] = self.expand
+        if self.count:
+            params["$inlinecount"] = "allpages"
+        return params
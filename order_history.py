@@ -0,0 +1,95 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+import odata_client
+import order_index
+from odata_query import Query, Guid, eq, ge, all_of, any_of
+
+HISTORY_LIMIT = 10
+REFRESH_SECONDS = float(os.getenv('ORDER_HISTORY_TTL', '30'))
+CACHE_SIZE = int(os.getenv('ORDER_HISTORY_SIZE', '5000'))
+DETAIL_FIELDS = order_index.ORDER_FIELDS + ["Клиенты_Key", "Товары"]
+EXPAND = "Товары($expand=Продукты)"
+
+# Ref_Key -> заказ с товарами; завершенные заказы больше не перечитываются
+_orders = OrderedDict()
+# Ref_Key -> когда заказ прочитан из 1С
+_fetched_at = {}
+# Клиенты_Key -> ключи последних заказов (новые первыми) и время последней сверки с 1С
+_clients = {}
+_stats = {'hits': 0, 'refreshes': 0, 'full_loads': 0}
+
+
+def _remember(order):
+    _orders[order['Ref_Key']] = order
+    _orders.move_to_end(order['Ref_Key'])
+    _fetched_at[order['Ref_Key']] = time.monotonic()
+    while len(_orders) > CACHE_SIZE:
+        key, _ = _orders.popitem(last=False)
+        _fetched_at.pop(key, None)
+    order_index.remember(order)
+
+
+def _is_open(order):
+    return not order_index.is_final(order.get('СтатусЗаказа'))
+
+
+async def get_orders(client_key, limit=HISTORY_LIMIT):
+    """Последние заказы клиента; из 1С перечитываются только новые и незавершенные"""
+    history = _clients.get(client_key)
+    # часть заказов вытеснена из кэша - список собирается заново
+    if history and not all(key in _orders for key in history['keys']):
+        history = None
+    if history and time.monotonic() - history['refreshed_at'] < REFRESH_SECONDS:
+        _stats['hits'] += 1
+        return [_orders[key] for key in history['keys'][:limit]]
+    if history and history['keys']:
+        open_keys = [key for key in history['keys'] if _is_open(_orders[key])]
+        newest = datetime.strptime(_orders[history['keys'][0]]['Date'], '%Y-%m-%dT%H:%M:%S')
+        query_filter = all_of(
+            eq("Клиенты_Key", Guid(client_key)),
+            any_of(ge("Date", newest), *(eq("Ref_Key", Guid(key)) for key in open_keys))
+        )
+        top = limit + len(open_keys)
+        _stats['refreshes'] += 1
+    else:
+        history = None
+        query_filter = eq("Клиенты_Key", Guid(client_key))
+        top = limit
+        _stats['full_loads'] += 1
+    fresh = await odata_client.fetch_all(Query(
+        "Document_ЗаказКлиента",
+        fields=DETAIL_FIELDS,
+        filter=query_filter,
+        order="Date desc",
+        top=top,
+        expand=EXPAND
+    ))
+    for order in fresh:
+        _remember(order)
+    keys = {order['Ref_Key'] for order in fresh} | set(history['keys'] if history else [])
+    keys = sorted((key for key in keys if key in _orders), key=lambda key: _orders[key]['Date'], reverse=True)
+    _clients[client_key] = {'keys': keys[:limit], 'refreshed_at': time.monotonic()}
+    return [_orders[key] for key in keys[:limit]]
+
+
+async def get_order(order_key):
+    """Заказ с товарами из кэша; незавершенный заказ старше REFRESH_SECONDS и промах - один запрос к 1С"""
+    order = _orders.get(order_key)
+    if order is not None and (not _is_open(order) or time.monotonic() - _fetched_at[order_key] < REFRESH_SECONDS):
+        _stats['hits'] += 1
+        return order
+    order = await odata_client.fetch_one(Query("Document_ЗаказКлиента", key=order_key, fields=DETAIL_FIELDS, expand=EXPAND))
+    _remember(order)
+    return order
+
+
+def invalidate(client_key):
+    """У клиента появился заказ: при следующем просмотре список сверяется с 1С"""
+    if client_key in _clients:
+        _clients[client_key]['refreshed_at'] = 0
+
+
+def stats():
+    return {'orders': len(_orders), 'clients': len(_clients), **_stats}
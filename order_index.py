@@ -0,0 +1,56 @@
+import os
+import time
+from collections import OrderedDict
+
+INDEX_SIZE = int(os.getenv('ORDER_INDEX_SIZE', '5000'))
+FRESH_SECONDS = float(os.getenv('ORDER_INDEX_TTL', '60'))
+FINAL_STATUSES = {s.strip() for s in os.getenv('ORDER_FINAL_STATUSES', 'Выполнен,Доставлен,Отменен').split(',') if s.strip()}
+ORDER_FIELDS = ["Ref_Key", "Number", "Date", "СтатусЗаказа", "АдресДоставки", "СуммаЗаказов"]
+
+# Ref_Key -> поля заказа и, если известно, последнее назначение курьера
+_orders = OrderedDict()
+_numbers = {}
+_stats = {'hits': 0, 'misses': 0}
+
+
+def is_final(status, delivery_status=None):
+    return status in FINAL_STATUSES or delivery_status in FINAL_STATUSES
+
+
+def remember(order, delivery=None):
+    """Запоминает заказ; delivery - {'СтатусДоставки', 'Курьер'} или {} если назначения нет,
+    None если назначение не запрашивалось"""
+    key = order['Ref_Key']
+    record = _orders.pop(key, None) or {}
+    record.update({field: order[field] for field in ORDER_FIELDS if field in order})
+    if delivery is not None:
+        record['delivery'] = delivery
+        record['checked_at'] = time.monotonic()
+    _orders[key] = record
+    if record.get('Number'):
+        _numbers[record['Number']] = key
+    while len(_orders) > INDEX_SIZE:
+        _, evicted = _orders.popitem(last=False)
+        if _numbers.get(evicted.get('Number')) == evicted['Ref_Key']:
+            del _numbers[evicted['Number']]
+    return record
+
+
+def key_for(number):
+    return _numbers.get(number)
+
+
+def fresh_status(number):
+    """Полный статус заказа из памяти: завершенные заказы не меняются, открытые - пока не устарели"""
+    record = _orders.get(_numbers.get(number))
+    if record is not None and 'checked_at' in record:
+        delivery_status = record['delivery'].get('СтатусДоставки')
+        if is_final(record.get('СтатусЗаказа'), delivery_status) or time.monotonic() - record['checked_at'] < FRESH_SECONDS:
+            _stats['hits'] += 1
+            return record
+    _stats['misses'] += 1
+    return None
+
+
+def stats():
+    return {'orders': len(_orders), **_stats}
@@ -0,0 +1,87 @@
+import os
+import time
+import asyncio
+import logging
+import contextlib
+
+ORDER_WORKERS = int(os.getenv('ORDER_WORKERS', '4'))
+STOP_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+_queue = None
+_workers = []
+_process = None
+_stats = {'submitted': 0, 'processed': 0, 'failed': 0}
+_stage_latency = {}
+
+
+def record(stage_name, seconds):
+    latency = _stage_latency.setdefault(stage_name, {'count': 0, 'total': 0.0, 'max': 0.0})
+    latency['count'] += 1
+    latency['total'] += seconds
+    latency['max'] = max(latency['max'], seconds)
+
+
+@contextlib.contextmanager
+def stage(stage_name):
+    """Замеряет длительность этапа обработки заказа"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record(stage_name, time.monotonic() - started)
+
+
+def submit(job):
+    """Ставит подтвержденный заказ в очередь и сразу возвращает управление обработчику"""
+    job['enqueued_at'] = time.monotonic()
+    _queue.put_nowait(job)
+    _stats['submitted'] += 1
+
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        record('queue', time.monotonic() - job['enqueued_at'])
+        try:
+            with stage('total'):
+                await _process(job)
+            _stats['processed'] += 1
+        except Exception as e:
+            _stats['failed'] += 1
+            logger.error(f"Ошибка обработки заказа пользователя {job.get('user_id')}: {e}")
+        finally:
+            _queue.task_done()
+
+
+def start(process, workers=ORDER_WORKERS):
+    global _queue, _process
+    _queue = asyncio.Queue()
+    _process = process
+    for _ in range(workers):
+        _workers.append(asyncio.create_task(_worker()))
+
+
+async def stop():
+    # даем воркерам дообработать принятые заказы
+    if _queue is not None:
+        try:
+            await asyncio.wait_for(_queue.join(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Не обработано заказов при остановке: {_queue.qsize()}")
+    for worker in _workers:
+        worker.cancel()
+    _workers.clear()
+
+
+def pipeline_stats():
+    return {
+        'queue_depth': _queue.qsize() if _queue is not None else 0,
+        'workers': len(_workers),
+        **_stats,
+        'stages': {
+            name: {'count': latency['count'], 'avg': round(latency['total'] / latency['count'], 3), 'max': round(latency['max'], 3)}
+            for name, latency in _stage_latency.items()
+        },
+    }
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import threading
+
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', 'outbox.sqlite3')
+POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))
+BASE_BACKOFF = 5
+MAX_BACKOFF = 300
+# завершенные записи нужны только для защиты от повторного подтверждения той же корзины
+RETENTION_DAYS = float(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+PRUNE_INTERVAL = 3600
+
+logger = logging.getLogger(__name__)
+
+_conn = None
+_db_lock = threading.Lock()
+_in_progress = set()
+_on_due = None
+_task = None
+
+
+def init(path=OUTBOX_PATH):
+    """Открывает файл очереди записей в 1С; WAL, чтобы запись не блокировала чтение"""
+    global _conn
+    _conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        )
+    """)
+    columns = {row[1] for row in _conn.execute("PRAGMA table_info(outbox)")}
+    # файлы, созданные до появления ключей идемпотентности
+    if 'idempotency_key' not in columns:
+        _conn.execute("ALTER TABLE outbox ADD COLUMN idempotency_key TEXT")
+    if 'order_number' not in columns:
+        _conn.execute("ALTER TABLE outbox ADD COLUMN order_number TEXT")
+    _conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt_at)")
+    _conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS outbox_idempotency_key ON outbox (idempotency_key)")
+    _conn.execute("CREATE INDEX IF NOT EXISTS outbox_created ON outbox (status, created_at)")
+
+
+def _execute(sql, params=()):
+    with _db_lock:
+        return _conn.execute(sql, params).fetchall()
+
+
+def _insert(user_id, payload, idempotency_key):
+    with _db_lock:
+        cursor = _conn.execute(
+            "INSERT INTO outbox (user_id, payload, idempotency_key, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, json.dumps(payload, ensure_ascii=False), idempotency_key, time.time())
+        )
+        return cursor.lastrowid
+
+
+async def add(user_id, payload, idempotency_key=None):
+    """Сохраняет заказ до отправки в 1С; возвращает id записи, она уже считается взятой в работу"""
+    entry_id = await asyncio.to_thread(_insert, user_id, payload, idempotency_key)
+    _in_progress.add(entry_id)
+    return entry_id
+
+
+async def find(idempotency_key):
+    """Запись, уже созданная по этому ключу идемпотентности, или None"""
+    rows = await asyncio.to_thread(
+        _execute, "SELECT id, status, order_number FROM outbox WHERE idempotency_key = ?", (idempotency_key,)
+    )
+    if not rows:
+        return None
+    return {'id': rows[0][0], 'status': rows[0][1], 'order_number': rows[0][2]}
+
+
+async def mark_done(entry_id, order_number=None):
+    _in_progress.discard(entry_id)
+    await asyncio.to_thread(
+        _execute,
+        "UPDATE outbox SET status = 'done', order_number = ?, last_error = NULL WHERE id = ?",
+        (order_number, entry_id)
+    )
+
+
+async def mark_failed(entry_id, error):
+    _in_progress.discard(entry_id)
+    await asyncio.to_thread(_execute, "UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?", (str(error), entry_id))
+
+
+async def reschedule(entry_id, attempts, error):
+    """Откладывает повтор с экспоненциальной задержкой и джиттером"""
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempts) * random.uniform(0.5, 1.0)
+    _in_progress.discard(entry_id)
+    await asyncio.to_thread(
+        _execute,
+        "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+        (attempts + 1, time.time() + delay, str(error), entry_id)
+    )
+
+
+def _due(limit):
+    rows = _execute(
+        "SELECT id, user_id, payload, attempts FROM outbox "
+        "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+        (time.time(), limit)
+    )
+    return [{'id': row[0], 'user_id': row[1], 'payload': json.loads(row[2]), 'attempts': row[3]} for row in rows]
+
+
+def _prune():
+    """Удаляет отправленные и отклоненные записи старше RETENTION_DAYS"""
+    with _db_lock:
+        cursor = _conn.execute(
+            "DELETE FROM outbox WHERE status IN ('done', 'failed') AND created_at < ?",
+            (time.time() - RETENTION_DAYS * 86400,)
+        )
+        return cursor.rowcount
+
+
+async def _replay_loop():
+    # после перезапуска сюда попадут и заказы, не отправленные прошлым процессом
+    pruned_at = 0.0
+    while True:
+        if time.monotonic() - pruned_at >= PRUNE_INTERVAL:
+            pruned_at = time.monotonic()
+            try:
+                removed = await asyncio.to_thread(_prune)
+                if removed:
+                    logger.info(f"Из очереди записей в 1С удалено старых записей: {removed}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки очереди записей в 1С: {e}")
+        try:
+            for entry in await asyncio.to_thread(_due, 100):
+                if entry['id'] in _in_progress:
+                    continue
+                _in_progress.add(entry['id'])
+                _on_due(entry)
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди записей в 1С: {e}")
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def start(on_due):
+    """on_due(entry) вызывается для каждой записи, которую пора (повторно) отправить в 1С, по порядку id"""
+    global _on_due, _task
+    if _conn is None:
+        init()
+    _on_due = on_due
+    _task = asyncio.create_task(_replay_loop())
+
+
+def stop():
+    if _task is not None:
+        _task.cancel()
+
+
+async def stats():
+    rows = await asyncio.to_thread(_execute, "SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    return {status: count for status, count in rows}
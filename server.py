@@ -1,13 +1,12 @@
 import os
 import logging
 import json
-import re
 import uuid
 import asyncio
-import urllib.parse
 import io
-import requests
+import math
 from datetime import datetime
+from collections import Counter
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -21,11 +20,28 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import BotCommand
+import odata_client
+import catalog_cache
+import circuit_breaker
+import courier_pool
+import order_pipeline
+import outbox
+import status_watcher
+import order_index
+import order_history
+import dispatcher
+import clients
+import client_index
+import session_store
+import fsm_storage
+from cart import Cart
+from odata_query import Query, Guid, eq, all_of
 
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ODATA_URL = os.getenv('ODATA_URL', 'http://localhost/proekt/odata/standard.odata/')
 ADMIN_PHONE = os.getenv('ADMIN_PHONE', '+79139849805')
+CART_IDLE_TTL = float(os.getenv('CART_IDLE_TTL', '86400'))
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не указан в .env файле!")
@@ -34,10 +50,16 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+dp = Dispatcher(storage=fsm_storage.create())
 
-user_carts = {}
-user_sessions = {}
+# сессии и корзины по id пользователя; хранилище задается SESSION_BACKEND
+sessions = session_store.Store('sessions')
+carts = session_store.Store('carts', idle_ttl=CART_IDLE_TTL)
+
+async def get_cart(user_id):
+    return Cart.load(await carts.get(user_id))
+# ключи корзин, подтверждение которых обрабатывается прямо сейчас
+confirming_checkouts = set()
 
 class OrderStates(StatesGroup):
     selecting_products = State()
@@ -49,10 +71,6 @@ class OrderStates(StatesGroup):
 class AuthStates(StatesGroup):
     entering_phone = State()
 
-def decode_response(response):
-    response.encoding = 'utf-8-sig'
-    return response.json()
-
 async def set_bot_commands(bot: Bot):
     commands = [
         BotCommand(command="start", description="Запуск бота"),
@@ -69,14 +87,53 @@ async def set_bot_commands(bot: Bot):
     ]
     await bot.set_my_commands(commands)
 
+def error_text(e, default):
+    if isinstance(e, circuit_breaker.CircuitOpenError):
+        return "⏳ Сервер 1С временно недоступен, попробуйте через минуту"
+    return default
+
+async def client_owners():
+    return {session['client_key']: int(user_id) for user_id, session in (await sessions.items()).items() if session.get('client_key')}
+
+def client_session(client, phone=None):
+    phone = phone or client.get('НомерТелефона', '')
+    return {
+        'client_key': client['Ref_Key'],
+        'phone': phone,
+        'name': client['Description'],
+        'address': client.get('АдрессДоставки', ''),
+        'is_admin': phone == ADMIN_PHONE
+    }
+
+async def user_session(user_id):
+    """Сессия пользователя; клиенты, зарегистрированные с этим telegram_id, входят без /login"""
+    session = await sessions.get(user_id)
+    if session is not None:
+        return session
+    try:
+        client = await client_index.lookup(user_id)
+    except Exception as e:
+        logger.error(f"Ошибка поиска клиента по telegram_id: {e}")
+        return None
+    if client is None:
+        return None
+    session = client_session(client)
+    sessions.set(user_id, session)
+    logger.info(f"✅ Пользователь {user_id} авторизован автоматически как {client['Description']}")
+    return session
+
 async def is_user_authenticated(user_id):
-    return user_id in user_sessions and user_sessions[user_id].get('client_key')
+    session = await user_session(user_id)
+    return bool(session and session.get('client_key'))
+
+async def is_admin(user_id):
+    session = await user_session(user_id)
+    return bool(session and session.get('is_admin'))
 
 @dp.message(Command("start", "help"))
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
-    is_admin = user_sessions.get(user_id, {}).get('is_admin', False)
-    admin_commands = "\n/reports - Просмотр отчетов (только для администраторов)" if is_admin else ""
+    admin_commands = "\n/reports - Просмотр отчетов (только для администраторов)\n/stats - Нагрузка бота (только для администраторов)" if await is_admin(user_id) else ""
     await message.answer(
         "<b>🤖 Бот доставки продуктов</b>\n\n"
         "Добро пожаловать! Я помогу вам заказать продукты с доставкой.\n\n"
@@ -107,44 +164,39 @@ async def cmd_login(message: types.Message, state: FSMContext):
 async def process_phone(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     phone = message.text.strip()
-    if not re.match(r'^\+?\d{10,12}$', phone):
+    if not clients.is_valid_phone(phone):
         await message.answer("❌ Неверный формат номера телефона. Попробуйте снова:")
         return
     try:
-        phone_encoded = urllib.parse.quote(phone)
-        user_id_encoded = urllib.parse.quote(str(user_id))
-        url = f"{ODATA_URL}Catalog_Клиенты?$filter=НомерТелефона eq '{phone_encoded}' and telegram_id eq '{user_id_encoded}'&$format=json"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        clients = decode_response(response).get('value', [])
-        if not clients:
+        found = await odata_client.fetch_all(Query(
+            "Catalog_Клиенты",
+            fields=["Ref_Key", "Description", "АдрессДоставки"],
+            filter=all_of(eq("НомерТелефона", phone), eq("telegram_id", str(user_id))),
+            top=1
+        ))
+        if not found:
             await message.answer("❌ Клиент с таким номером телефона не найден. Зарегистрируйтесь с помощью /newclient")
             await state.clear()
             return
-        client = clients[0]
-        user_sessions[user_id] = {
-            'client_key': client['Ref_Key'],
-            'phone': phone,
-            'name': client['Description'],
-            'address': client.get('АдрессДоставки', ''),
-            'is_admin': phone == ADMIN_PHONE
-        }
+        client = found[0]
+        client_index.remember({**client, 'НомерТелефона': phone, 'telegram_id': user_id})
+        await client_index.login(user_id)
+        session = client_session(client, phone)
+        sessions.set(user_id, session)
         await message.answer(
             f"✅ Успешная авторизация, {client['Description']}!"
-            + (" Вы вошли как администратор. для отчета введите команду /reports" if user_sessions[user_id]['is_admin'] else "")
+            + (" Вы вошли как администратор. для отчета введите команду /reports" if session['is_admin'] else "")
         )
         await state.clear()
     except Exception as e:
         logger.error(f"Ошибка авторизации: {e}")
-        await message.answer("⚠️ Ошибка при авторизации")
+        await message.answer(error_text(e, "⚠️ Ошибка при авторизации"))
         await state.clear()
 
 @dp.message(Command("products"))
 async def cmd_products(message: types.Message):
     try:
-        response = requests.get(f"{ODATA_URL}Catalog_Товары?$filter=DeletionMark eq false&$top=20&$format=json", timeout=10)
-        response.raise_for_status()
-        products = decode_response(response).get('value', [])
+        products = (await catalog_cache.get_products())[:20]
         if not products:
             await message.answer("🛍️ Товаров не найдено")
             return
@@ -168,7 +220,40 @@ async def cmd_products(message: types.Message):
                 await message.answer(text)
     except Exception as e:
         logger.error(f"Ошибка получения товаров: {e}")
-        await message.answer("⚠️ Ошибка получения списка товаров")
+        await message.answer(error_text(e, "⚠️ Ошибка получения списка товаров"))
+
+def build_products_keyboard(products, page, pages):
+    builder = InlineKeyboardBuilder()
+    for product in products:
+        builder.add(types.InlineKeyboardButton(
+            text=f"{product.get('Description', '')} ({product.get('Цена', 'N/A')} руб.)",
+            callback_data=f"product_{product['Ref_Key']}"
+        ))
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton(text="◀️", callback_data=f"page_{page - 1}"))
+    nav.append(types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="page_info"))
+    if page < pages - 1:
+        nav.append(types.InlineKeyboardButton(text="▶️", callback_data=f"page_{page + 1}"))
+    builder.add(*nav)
+    builder.add(types.InlineKeyboardButton(text="🗂 Категории", callback_data="categories"))
+    builder.add(types.InlineKeyboardButton(text="🛒 Завершить выбор", callback_data="finish_selection"))
+    builder.adjust(*([1] * len(products)), len(nav), 1, 1)
+    return builder.as_markup()
+
+async def get_products_keyboard(state: FSMContext):
+    data = await state.get_data()
+    page = data.get('catalog_page', 0)
+    category = data.get('catalog_category')
+    products, total = await catalog_cache.get_page(page, category)
+    if not products and page > 0:
+        page = 0
+        products, total = await catalog_cache.get_page(page, category)
+        await state.update_data(catalog_page=page)
+    if not products:
+        return None
+    pages = max(1, math.ceil(total / catalog_cache.PAGE_SIZE))
+    return build_products_keyboard(products, page, pages)
 
 @dp.message(Command("neworder"))
 async def cmd_new_order(message: types.Message, state: FSMContext):
@@ -176,27 +261,27 @@ async def cmd_new_order(message: types.Message, state: FSMContext):
     if not await is_user_authenticated(user_id):
         await message.answer("🔐 Пожалуйста, авторизуйтесь с помощью /login\nИли зарегистрируйтесь с помощью /newclient")
         return
-    user_carts[user_id] = []
+    # непустая корзина остается: ее возвращает неудачное оформление, и заказ можно отправить снова
+    cart = await get_cart(user_id)
+    if not cart:
+        carts.set(user_id, Cart())
     try:
-        response = requests.get(f"{ODATA_URL}Catalog_Товары?$filter=DeletionMark eq false&$format=json", timeout=10)
-        response.raise_for_status()
-        products = decode_response(response).get('value', [])
-        if not products:
+        if cart:
+            await message.answer(
+                f"🛒 В корзине уже есть товары на {cart.total:.2f} руб. Добавьте еще или нажмите «Завершить выбор».\n"
+                "Очистить корзину: /cart"
+            )
+        # ключ идемпотентности корзины, он же Ref_Key будущего заказа
+        await state.update_data(catalog_page=0, catalog_category=None, checkout_key=str(uuid.uuid4()))
+        keyboard = await get_products_keyboard(state)
+        if keyboard is None:
             await message.answer("🛍️ Товары отсутствуют")
             return
-        builder = InlineKeyboardBuilder()
-        for product in products:
-            builder.add(types.InlineKeyboardButton(
-                text=f"{product.get('Description', '')} ({product.get('Цена', 'N/A')} руб.)",
-                callback_data=f"product_{product['Ref_Key']}"
-            ))
-        builder.add(types.InlineKeyboardButton(text="🛒 Завершить выбор", callback_data="finish_selection"))
-        builder.adjust(1)
-        await message.answer("📦 Выберите товары:", reply_markup=builder.as_markup())
+        await message.answer("📦 Выберите товары:", reply_markup=keyboard)
         await state.set_state(OrderStates.selecting_products)
     except Exception as e:
         logger.error(f"Ошибка начала заказа: {e}")
-        await message.answer("⚠️ Ошибка при создании заказа")
+        await message.answer(error_text(e, "⚠️ Ошибка при создании заказа"))
 
 @dp.callback_query(lambda c: c.data.startswith("product_"), OrderStates.selecting_products)
 async def select_product(callback: types.CallbackQuery, state: FSMContext):
@@ -216,60 +301,90 @@ async def enter_quantity(message: types.Message, state: FSMContext):
             return
         data = await state.get_data()
         product_id = data['current_product']
-        response = requests.get(f"{ODATA_URL}Catalog_Товары(guid'{product_id}')?$format=json", timeout=10)
-        response.raise_for_status()
-        product = decode_response(response)
-        if user_id not in user_carts:
-            user_carts[user_id] = []
-        user_carts[user_id].append({
-            'Ref_Key': product_id,
-            'Description': product['Description'],
-            'Цена': float(product.get('Цена', 0) or 0),
-            'Quantity': quantity,
-            'Изображение': product.get('Изображение', '')
-        })
+        product = catalog_cache.lookup(product_id) or await catalog_cache.get_product(product_id)
+        if product is None:
+            await message.answer("❌ Товар больше не доступен")
+            await show_product_selection(message, state)
+            return
+        cart = await get_cart(user_id)
+        cart.add(product_id, product['Description'], float(product.get('Цена', 0) or 0), quantity, product.get('Изображение', ''))
+        carts.set(user_id, cart)
         await message.answer(f"✅ Добавлено: {product['Description']} x{quantity}")
-        cart_message = "<b>🛒 Текущая корзина:</b>\n\n"
-        total = 0
-        for item in user_carts[user_id]:
-            item_total = item['Цена'] * item['Quantity']
-            cart_message += f"▪ {item['Description']} x{item['Quantity']} = {item_total:.2f} руб.\n"
-            total += item_total
-        cart_message += f"\n<b>💰 Итого: {total:.2f} руб.</b>"
-        await message.answer(cart_message)
+        await message.answer(f"<b>🛒 Текущая корзина:</b>\n\n{cart.render()}\n<b>💰 Итого: {cart.total:.2f} руб.</b>")
         await show_product_selection(message, state)
     except ValueError:
         await message.answer("❌ Введите число")
     except Exception as e:
         logger.error(f"Ошибка добавления товара: {e}")
-        await message.answer("⚠️ Ошибка при добавлении товара")
+        await message.answer(error_text(e, "⚠️ Ошибка при добавлении товара"))
 
 async def show_product_selection(message: types.Message, state: FSMContext):
     try:
-        response = requests.get(f"{ODATA_URL}Catalog_Товары?$filter=DeletionMark eq false&$format=json", timeout=10)
-        response.raise_for_status()
-        products = decode_response(response).get('value', [])
-        if not products:
+        keyboard = await get_products_keyboard(state)
+        if keyboard is None:
             await message.answer("🛍️ Товары отсутствуют")
             return
-        builder = InlineKeyboardBuilder()
-        for product in products:
-            builder.add(types.InlineKeyboardButton(
-                text=f"{product.get('Description', '')} ({product.get('Цена', 'N/A')} руб.)",
-                callback_data=f"product_{product['Ref_Key']}"
-            ))
-        builder.add(types.InlineKeyboardButton(text="🛒 Завершить выбор", callback_data="finish_selection"))
-        builder.adjust(1)
-        await message.answer("📦 Выберите товары:", reply_markup=builder.as_markup())
+        await message.answer("📦 Выберите товары:", reply_markup=keyboard)
         await state.set_state(OrderStates.selecting_products)
     except Exception as e:
         logger.error(f"Ошибка показа товаров: {e}")
-        await message.answer("⚠️ Ошибка при отображении товаров")
+        await message.answer(error_text(e, "⚠️ Ошибка при отображении товаров"))
+
+@dp.callback_query(lambda c: c.data.startswith("page_"), OrderStates.selecting_products)
+async def change_page(callback: types.CallbackQuery, state: FSMContext):
+    if callback.data == "page_info":
+        await callback.answer()
+        return
+    try:
+        await state.update_data(catalog_page=int(callback.data.split("_")[1]))
+        keyboard = await get_products_keyboard(state)
+        if keyboard is None:
+            await callback.message.edit_text("🛍️ Товары отсутствуют")
+        else:
+            await callback.message.edit_text("📦 Выберите товары:", reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Ошибка переключения страницы: {e}")
+        await callback.message.answer(error_text(e, "⚠️ Ошибка при отображении товаров"))
+    await callback.answer()
+
+@dp.callback_query(lambda c: c.data == "categories", OrderStates.selecting_products)
+async def show_categories(callback: types.CallbackQuery):
+    try:
+        categories = await catalog_cache.get_categories()
+        builder = InlineKeyboardBuilder()
+        builder.add(types.InlineKeyboardButton(text="📦 Все товары", callback_data="category_all"))
+        for idx, category in enumerate(categories):
+            builder.add(types.InlineKeyboardButton(text=category, callback_data=f"category_{idx}"))
+        builder.adjust(1)
+        await callback.message.edit_text("🗂 Выберите категорию:", reply_markup=builder.as_markup())
+    except Exception as e:
+        logger.error(f"Ошибка получения категорий: {e}")
+        await callback.message.answer(error_text(e, "⚠️ Ошибка при получении категорий"))
+    await callback.answer()
+
+@dp.callback_query(lambda c: c.data.startswith("category_"), OrderStates.selecting_products)
+async def select_category(callback: types.CallbackQuery, state: FSMContext):
+    try:
+        category = None
+        if callback.data != "category_all":
+            categories = await catalog_cache.get_categories()
+            idx = int(callback.data.split("_")[1])
+            category = categories[idx] if idx < len(categories) else None
+        await state.update_data(catalog_page=0, catalog_category=category)
+        keyboard = await get_products_keyboard(state)
+        if keyboard is None:
+            await callback.message.edit_text("🛍️ Товары отсутствуют")
+        else:
+            await callback.message.edit_text("📦 Выберите товары:", reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Ошибка выбора категории: {e}")
+        await callback.message.answer(error_text(e, "⚠️ Ошибка при отображении товаров"))
+    await callback.answer()
 
 @dp.callback_query(lambda c: c.data == "finish_selection", OrderStates.selecting_products)
 async def finish_selection(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    if not user_carts.get(user_id):
+    if not await get_cart(user_id):
         await callback.message.edit_text("🛒 Корзина пуста")
         await state.clear()
         return
@@ -287,7 +402,7 @@ async def select_payment(callback: types.CallbackQuery, state: FSMContext):
     payment_method = callback.data.split("_")[1]
     await state.update_data(payment_method=payment_method)
     user_id = callback.from_user.id
-    default_address = user_sessions[user_id].get('address', '')
+    default_address = (await sessions.get(user_id) or {}).get('address', '')
     await callback.message.edit_text(f"📍 Введите адрес доставки\n(Текущий адрес: {default_address}):")
     await state.set_state(OrderStates.entering_address)
     await callback.answer()
@@ -301,36 +416,104 @@ async def enter_address(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     await state.update_data(address=address)
     data = await state.get_data()
-    cart = user_carts.get(user_id, [])
-    total = sum(item['Цена'] * item['Quantity'] for item in cart)
-    order_text = "<b>🛒 Подтверждение заказа:</b>\n\n"
-    for item in cart:
-        order_text += f"{item['Description']} x{item['Quantity']} = {item['Цена'] * item['Quantity']:.2f} руб.\n"
-        if item.get('Изображение'):
+    cart = await get_cart(user_id)
+    await send_cart_photos(message, cart)
+    order_text = f"<b>🛒 Подтверждение заказа:</b>\n\n{cart.render()}"
+    order_text += f"\n💰 <b>Итого:</b> {cart.total:.2f} руб.\n"
+    order_text += f"💳 <b>Оплата:</b> {'Наличные' if data['payment_method'] == 'cash' else 'Карта'}\n"
+    order_text += f"📍 <b>Адрес:</b> {address}"
+    await message.answer(order_text, reply_markup=build_confirm_keyboard())
+    await state.set_state(OrderStates.confirming_order)
+
+async def send_cart_photos(message: types.Message, cart):
+    for line in cart:
+        if line.image:
             try:
-                await message.answer_photo(photo=item['Изображение'], caption=f"{item['Description']}")
+                await message.answer_photo(photo=line.image, caption=line.description)
             except Exception:
                 pass
-    order_text += f"\n💰 <b>Итого:</b> {total:.2f} руб.\n"
-    order_text += f"💳 <b>Оплата:</b> {'Наличные' if data['payment_method'] == 'cash' else 'Карта'}\n"
-    order_text += f"📍 <b>Адрес:</b> {address}"
+
+def build_confirm_keyboard():
     builder = InlineKeyboardBuilder()
     builder.add(
         types.InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_order"),
         types.InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_order")
     )
-    await message.answer(order_text, reply_markup=builder.as_markup())
-    await state.set_state(OrderStates.confirming_order)
+    return builder.as_markup()
+
+async def revalidate_cart(user_id):
+    cart = await get_cart(user_id)
+    fresh = await catalog_cache.revalidate(list(cart.lines))
+    changes = []
+    for line in cart:
+        product = fresh.get(line.ref_key)
+        if product is None:
+            cart.remove(line.ref_key)
+            changes.append(f"❌ {line.description} больше не продается")
+            continue
+        price = float(product.get('Цена', 0) or 0)
+        if price != line.price:
+            changes.append(f"💱 {line.description}: {line.price:.2f} → {price:.2f} руб.")
+            cart.set_price(line.ref_key, price)
+    if changes:
+        carts.set(user_id, cart)
+        catalog_cache.invalidate()
+    return changes
 
 @dp.callback_query(lambda c: c.data == "confirm_order", OrderStates.confirming_order)
 async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
     data = await state.get_data()
-    cart = user_carts.get(user_id, [])
-    total = sum(item['Цена'] * item['Quantity'] for item in cart)
+    checkout_key = data.get('checkout_key') or str(uuid.uuid4())
+    # повторное нажатие, пока первое еще обрабатывается
+    if checkout_key in confirming_checkouts:
+        await callback.answer("⏳ Заказ уже оформляется")
+        return
+    confirming_checkouts.add(checkout_key)
     try:
-        client_key = user_sessions[user_id]['client_key']
+        await place_order(callback, state, data, checkout_key)
+    finally:
+        confirming_checkouts.discard(checkout_key)
+
+async def place_order(callback: types.CallbackQuery, state: FSMContext, data, checkout_key):
+    user_id = callback.from_user.id
+    existing = await outbox.find(checkout_key)
+    if existing:
+        if existing['status'] == 'done':
+            text = f"✅ Заказ №{existing['order_number'] or 'N/A'} уже создан"
+        elif existing['status'] == 'pending':
+            text = "⏳ Этот заказ уже принят и обрабатывается"
+        else:
+            text = "⚠️ Этот заказ создать не удалось, оформите новый: /neworder"
+        await callback.message.edit_text(text)
+        await state.clear()
+        await callback.answer()
+        return
+    try:
+        changes = await revalidate_cart(user_id)
+    except Exception as e:
+        logger.error(f"Ошибка проверки корзины: {e}")
+        changes = []
+    cart = await get_cart(user_id)
+    if changes:
+        if not cart:
+            await callback.message.edit_text("\n".join(changes) + "\n\n🛒 Корзина пуста")
+            await state.clear()
+        else:
+            await callback.message.edit_text(
+                "<b>⚠️ Корзина изменилась:</b>\n" + "\n".join(changes)
+                + f"\n\n💰 <b>Новая сумма:</b> {cart.total:.2f} руб.\nПодтвердите заказ еще раз.",
+                reply_markup=build_confirm_keyboard()
+            )
+        await callback.answer()
+        return
+    total = cart.total
+    try:
+        client_key = (await sessions.get(user_id))['client_key']
+        # Ref_Key задаем сами (ключ корзины), чтобы назначение курьера ушло в одном $batch с заказом,
+        # а повторная отправка не создала в 1С второй документ
+        order_key = checkout_key
         order_data = {
+            "Ref_Key": order_key,
             "Date": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
             "Клиенты_Key": client_key,
             "СуммаЗаказов": str(total),
@@ -341,76 +524,168 @@ async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
                 {
                     "Ref_Key": str(uuid.uuid4()),
                     "LineNumber": idx + 1,
-                    "Продукты_Key": item["Ref_Key"],
-                    "Количество": item["Quantity"]
-                } for idx, item in enumerate(cart)
+                    "Продукты_Key": line.ref_key,
+                    "Количество": line.quantity
+                } for idx, line in enumerate(cart)
             ]
         }
-        headers = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'application/json', 'Prefer': 'return=representation'}
-        response = requests.post(f"{ODATA_URL}Document_ЗаказКлиента", json=order_data, headers=headers, timeout=15)
-        if response.status_code != 201:
-            raise Exception(f"Ошибка создания заказа: {response.text}")
-        order_info = decode_response(response)
-        order_key = order_info['Ref_Key']
-        order_number = order_info.get('Number', 'N/A')
-        courier_assigned = await assign_courier(order_key, user_id, data["address"])
-        if courier_assigned:
-            update_data = {"Курьер_Key": courier_assigned['courier_key'], "СтатусЗаказа": "В обработке"}
-            update_response = requests.patch(f"{ODATA_URL}Document_ЗаказКлиента(guid'{order_key}')", json=update_data, headers=headers, timeout=10)
-            if update_response.status_code != 200:
-                logger.error(f"Ошибка обновления заказа: {update_response.text}")
+        job = {
+            'user_id': user_id,
+            'order_data': order_data,
+            'address': data["address"],
+            'total': total,
+            'cart': cart.to_dict()
+        }
+        # сначала заказ ложится в локальный outbox, запись в 1С и назначение курьера делают воркеры
+        job['outbox_id'] = await outbox.add(user_id, job, checkout_key)
+        job['attempts'] = 0
+        order_pipeline.submit(job)
         await callback.message.edit_text(
-            f"✅ Заказ №{order_number} создан!\n"
-            f"📍 Адрес доставки: {data['address']}\n"
+            f"⏳ Заказ принят!\n"
             f"💰 Сумма: {total:.2f} руб.\n"
-            f"🚴 Курьер: {courier_assigned.get('courier_name', 'будет назначен')}"
+            f"Номер заказа и курьера пришлю отдельным сообщением."
         )
-        user_carts.pop(user_id, None)
+        carts.delete(user_id)
     except Exception as e:
         logger.error(f"Ошибка создания заказа: {e}")
-        await callback.message.edit_text(f"⚠️ Ошибка при создании заказа: {str(e)}")
+        await callback.message.edit_text(error_text(e, f"⚠️ Ошибка при создании заказа: {str(e)}"))
     finally:
         await state.clear()
+        await callback.answer()
+
+def submit_outbox_entry(entry):
+    job = entry['payload']
+    job['outbox_id'] = entry['id']
+    job['attempts'] = entry['attempts']
+    # запись из очереди могла уйти в 1С до падения или остановки, даже если попыток не было
+    job['replayed'] = True
+    order_pipeline.submit(job)
+
+async def find_written_order(order_key):
+    """Заказ, записанный прошлой попыткой, и курьер из его назначения (или None) одним $batch"""
+    orders, assignments = await odata_client.read_batch([
+        Query(
+            "Document_ЗаказКлиента",
+            fields=["Ref_Key", "Number"],
+            filter=eq("Ref_Key", Guid(order_key))
+        ),
+        Query(
+            "Document_НазначениеКурьера",
+            fields=["Курьер_Key", "Курьер/Description"],
+            filter=all_of(eq("DeletionMark", False), eq("Заказ_Key", Guid(order_key))),
+            expand="Курьер",
+            top=1
+        ),
+    ])
+    if not orders:
+        return None, None
+    if not assignments:
+        return orders[0], None
+    assignment = assignments[0]
+    return orders[0], {'Ref_Key': assignment['Курьер_Key'], 'Description': (assignment.get('Курьер') or {}).get('Description')}
 
-async def assign_courier(order_key, user_id, address):
+async def assign_written_order(order_key, address):
+    """Курьер для заказа, который уже есть в 1С без назначения: без $batch заказ и назначение пишутся
+    по одному, и назначение могло не записаться"""
+    courier = await courier_pool.reserve(order_key)
+    if courier is None:
+        return None
     try:
-        response = requests.get(f"{ODATA_URL}Catalog_Курьеры?$filter=DeletionMark eq false and Статус eq 'Свободен'&$top=1&$format=json", timeout=10)
-        response.raise_for_status()
-        couriers = decode_response(response).get('value', [])
-        if not couriers:
-            await bot.send_message(user_id, "⚠️ Нет свободных курьеров, доставка будет назначена позже")
-            return None
-        courier = couriers[0]
-        courier_key = courier['Ref_Key']
-        courier_name = courier.get('Description', 'Неизвестный курьер')
-        assignment = {
-            "Ref_Key": str(uuid.uuid4()),
-            "Date": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
-            "DeletionMark": False,
-            "Posted": True,
-            "Заказ_Key": order_key,
-            "Курьер_Key": courier_key,
-            "СтатусДоставки": "Назначен",
-            "АдресДоставки": address
-        }
-        headers = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'application/json'}
-        response = requests.post(f"{ODATA_URL}Document_НазначениеКурьера", json=assignment, headers=headers, timeout=10)
-        if response.status_code != 201:
-            raise Exception(f"Ошибка создания назначения курьера: {response.text}")
-        response = requests.patch(f"{ODATA_URL}Catalog_Курьеры(guid'{courier_key}')", json={"Статус": "Занят"}, headers=headers, timeout=10)
-        if response.status_code != 200:
-            raise Exception(f"Ошибка обновления статуса курьера: {response.text}")
-        await bot.send_message(user_id, f"🚴 Курьер {courier_name} назначен на ваш заказ!")
-        return {'courier_key': courier_key, 'courier_name': courier_name}
+        await odata_client.batch([
+            courier_pool.assignment_request(order_key, courier['Ref_Key'], address),
+            ("PATCH", f"Document_ЗаказКлиента(guid'{order_key}')", {"Курьер_Key": courier['Ref_Key'], "СтатусЗаказа": "В обработке"})
+        ])
+    except Exception:
+        courier_pool.release(order_key)
+        raise
+    courier_pool.commit(order_key)
+    return courier
+
+async def process_order(job):
+    user_id = job['user_id']
+    order_data = dict(job['order_data'])
+    order_key = order_data['Ref_Key']
+    courier = None
+    # прошлая попытка могла записать заказ, но не дождаться ответа
+    possibly_written = job['attempts'] or job.get('replayed')
+    try:
+        order_info, courier = await find_written_order(order_key) if possibly_written else (None, None)
+        unassigned = order_info is not None and courier is None
+        if order_info is None:
+            # в режиме окна курьера назначит dispatcher вместе с соседними заказами
+            if not dispatcher.enabled():
+                with order_pipeline.stage('courier'):
+                    courier = await courier_pool.reserve(order_key)
+            writes = [("POST", "Document_ЗаказКлиента", order_data)]
+            if courier:
+                order_data["Курьер_Key"] = courier['Ref_Key']
+                order_data["СтатусЗаказа"] = "В обработке"
+                writes.append(courier_pool.assignment_request(order_key, courier['Ref_Key'], job['address']))
+            try:
+                with order_pipeline.stage('write_1c'):
+                    order_info = (await odata_client.batch(writes))[0]
+            except Exception as e:
+                if courier:
+                    courier_pool.release(order_key)
+                if not getattr(e, 'completed', 0):
+                    raise
+                # заказ записан, а назначение нет: назначаем ниже, как при повторе
+                logger.error(f"Заказ {order_key} записан без назначения курьера: {e}")
+                courier = None
+                unassigned = True
+                order_info, _ = await find_written_order(order_key)
+            else:
+                if courier:
+                    courier_pool.commit(order_key)
+        if unassigned and not dispatcher.enabled():
+            try:
+                with order_pipeline.stage('courier'):
+                    courier = await assign_written_order(order_key, job['address'])
+                if courier:
+                    order_data["СтатусЗаказа"] = "В обработке"
+            except Exception as e:
+                if odata_client.is_transient_error(e):
+                    raise
+                # заказ уже в 1С, его не откатываем; курьера назначит оператор
+                logger.error(f"Ошибка назначения курьера заказу {order_key}: {e}")
     except Exception as e:
-        logger.error(f"Ошибка назначения курьера: {e}")
-        await bot.send_message(user_id, "⚠️ Ошибка при назначении курьера")
-        return None
+        if odata_client.is_transient_error(e):
+            await outbox.reschedule(job['outbox_id'], job['attempts'], e)
+            if not possibly_written:
+                await bot.send_message(user_id, "⏳ Сервер 1С сейчас недоступен. Заказ сохранен и будет отправлен автоматически.")
+            raise
+        await outbox.mark_failed(job['outbox_id'], e)
+        # возвращаем корзину, чтобы заказ можно было оформить повторно
+        if not await get_cart(user_id):
+            carts.set(user_id, Cart.from_dict(job['cart']))
+        await bot.send_message(user_id, f"⚠️ Ошибка при создании заказа: {str(e)}\nКорзина сохранена, оформить заново: /neworder")
+        raise
+    await outbox.mark_done(job['outbox_id'], order_info.get('Number'))
+    if dispatcher.enabled():
+        dispatcher.submit(order_key, job['address'], user_id, order_info.get('Number'))
+    courier_name = (courier.get('Description') or 'Неизвестный курьер') if courier else None
+    status_watcher.track(
+        order_key, user_id, order_info.get('Number'), order_data['Date'],
+        order_data['СтатусЗаказа'], "Назначен" if courier else None, courier_name
+    )
+    order_history.invalidate(order_data['Клиенты_Key'])
+    order_index.remember(
+        {**order_data, 'Number': order_info.get('Number')},
+        {'СтатусДоставки': "Назначен", 'Курьер': courier_name} if courier else {}
+    )
+    with order_pipeline.stage('notify'):
+        await bot.send_message(
+            user_id,
+            f"✅ Заказ №{order_info.get('Number', 'N/A')} создан!\n"
+            f"📍 Адрес доставки: {job['address']}\n"
+            f"💰 Сумма: {job['total']:.2f} руб.\n"
+            f"🚴 Курьер: {courier_name or 'будет назначен'}"
+        )
 
 @dp.callback_query(lambda c: c.data == "cancel_order", OrderStates.confirming_order)
 async def cancel_order(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    user_carts.pop(user_id, None)
+    carts.delete(user_id)
     await callback.message.edit_text("❌ Заказ отменен")
     await state.clear()
     await callback.answer()
@@ -421,22 +696,12 @@ async def cmd_cart(message: types.Message):
     if not await is_user_authenticated(user_id):
         await message.answer("🔐 Пожалуйста, авторизуйтесь с помощью /login\nИли зарегистрируйтесь с помощью /newclient")
         return
-    cart = user_carts.get(user_id, [])
+    cart = await get_cart(user_id)
     if not cart:
         await message.answer("🛒 Корзина пуста")
         return
-    text = "<b>🛒 Ваша корзина:</b>\n\n"
-    total = 0
-    for item in cart:
-        subtotal = item['Цена'] * item['Quantity']
-        text += f"{item['Description']} x{item['Quantity']} = {subtotal:.2f} руб.\n"
-        if item.get('Изображение'):
-            try:
-                await message.answer_photo(photo=item['Изображение'], caption=f"{item['Description']}")
-            except Exception:
-                pass
-        total += subtotal
-    text += f"\n💰 <b>Итого:</b> {total:.2f} руб."
+    await send_cart_photos(message, cart)
+    text = f"<b>🛒 Ваша корзина:</b>\n\n{cart.render()}\n💰 <b>Итого:</b> {cart.total:.2f} руб."
     builder = InlineKeyboardBuilder()
     builder.add(types.InlineKeyboardButton(text="🗑 Очистить", callback_data="clear_cart"))
     await message.answer(text, reply_markup=builder.as_markup())
@@ -444,7 +709,7 @@ async def cmd_cart(message: types.Message):
 @dp.callback_query(lambda c: c.data == "clear_cart")
 async def clear_cart(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    user_carts.pop(user_id, None)
+    carts.delete(user_id)
     await callback.message.edit_text("🛒 Корзина очищена")
     await callback.answer()
 
@@ -455,11 +720,8 @@ async def cmd_orders(message: types.Message):
         await message.answer("🔐 Пожалуйста, авторизуйтесь с помощью /login\nИли зарегистрируйтесь с помощью /newclient")
         return
     try:
-        client_key = user_sessions[user_id]['client_key']
-        url = f"{ODATA_URL}Document_ЗаказКлиента?$filter=Клиенты_Key eq guid'{client_key}'&$orderby=Date desc&$top=10&$format=json"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        orders = decode_response(response).get('value', [])
+        client_key = (await sessions.get(user_id))['client_key']
+        orders = await order_history.get_orders(client_key)
         if not orders:
             await message.answer("🛒 У вас пока нет заказов")
             return
@@ -472,16 +734,13 @@ async def cmd_orders(message: types.Message):
         await message.answer("📋 Ваши заказы:", reply_markup=builder.as_markup())
     except Exception as e:
         logger.error(f"Ошибка получения заказов: {e}")
-        await message.answer("⚠️ Ошибка при получении заказов")
+        await message.answer(error_text(e, "⚠️ Ошибка при получении заказов"))
 
 @dp.callback_query(lambda c: c.data.startswith("order_"))
 async def show_order_details(callback: types.CallbackQuery):
     order_id = callback.data.split("_")[1]
     try:
-        order_id_encoded = urllib.parse.quote(order_id)
-        response = requests.get(f"{ODATA_URL}Document_ЗаказКлиента(guid'{order_id_encoded}')?$expand=Товары($expand=Продукты)&$format=json", timeout=10)
-        response.raise_for_status()
-        order = decode_response(response)
+        order = await order_history.get_order(order_id)
         order_date = datetime.strptime(order['Date'], '%Y-%m-%dT%H:%M:%S').strftime('%d.%m.%Y %H:%M')
         products_text = ""
         for item in order.get('Товары', []):
@@ -499,7 +758,7 @@ async def show_order_details(callback: types.CallbackQuery):
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка получения деталей заказа: {e}")
-        await callback.answer("⚠️ Ошибка при получении деталей заказа", show_alert=True)
+        await callback.answer(error_text(e, "⚠️ Ошибка при получении деталей заказа"), show_alert=True)
 
 @dp.message(Command("newclient"))
 async def cmd_new_client(message: types.Message):
@@ -509,63 +768,85 @@ async def cmd_new_client(message: types.Message):
         return
     name, phone, address = args[1], args[2], args[3]
     user_id = str(message.from_user.id)
-    if not re.match(r'^\+?\d{10,12}$', phone):
+    if not clients.is_valid_phone(phone):
         await message.answer("❌ Неверный формат номера телефона")
         return
-    new_client = {
-        "Description": name,
-        "Code": phone[-6:],
-        "НомерТелефона": phone,
-        "АдрессДоставки": address,
-        "telegram_id": user_id
-    }
-    headers = {'Content-Type': 'application/json; charset=utf-8', 'Accept': 'application/json'}
+    new_client = clients.new_client_payload(name, phone, address, user_id)
     try:
-        response = requests.post(f"{ODATA_URL}Catalog_Клиенты", json=new_client, headers=headers, timeout=10)
-        if response.status_code == 201:
-            client = decode_response(response)
-            user_sessions[user_id] = {
-                'client_key': client['Ref_Key'],
-                'phone': phone,
-                'name': name,
-                'address': address,
-                'is_admin': phone == ADMIN_PHONE
-            }
-            await message.answer(f"✅ Клиент <b>{name}</b> успешно зарегистрирован(а)! Вы автоматически авторизованы.")
-        else:
-            logger.error(f"Ошибка создания клиента: {response.text}")
-            await message.answer("⚠️ Ошибка при создании клиента")
+        client = await odata_client.post("Catalog_Клиенты", new_client)
+        client_index.remember({**new_client, **client})
+        await client_index.login(user_id)
+        sessions.set(user_id, client_session({**new_client, **client}, phone))
+        await message.answer(f"✅ Клиент <b>{name}</b> успешно зарегистрирован(а)! Вы автоматически авторизованы.")
+    except odata_client.ODataError as e:
+        logger.error(f"Ошибка создания клиента: {e.text}")
+        await message.answer("⚠️ Ошибка при создании клиента")
     except Exception as e:
         logger.error(f"Ошибка создания клиента: {e}")
-        await message.answer(f"⚠️ Ошибка при создании клиента: {str(e)}")
+        await message.answer(error_text(e, f"⚠️ Ошибка при создании клиента: {str(e)}"))
 
 @dp.message(Command("couriers"))
 async def cmd_couriers(message: types.Message):
     try:
-        response = requests.get(f"{ODATA_URL}Catalog_Курьеры?$filter=DeletionMark eq false&$format=json", timeout=10)
-        response.raise_for_status()
-        couriers = decode_response(response).get('value', [])
+        couriers = await odata_client.fetch_all(Query(
+            "Catalog_Курьеры",
+            fields=["Description", "НомерТелефона", "Статус"],
+            filter=eq("DeletionMark", False),
+            top=10
+        ))
         if not couriers:
             await message.answer("🚴 Курьеров не найдено")
             return
         result = "<b>🚴 Доступные курьеры:</b>\n\n"
-        for c in couriers[:10]:
+        for c in couriers:
             result += f"<b>{c.get('Description', 'Без имени')}</b>\n📞 <i>{c.get('НомерТелефона', 'не указан')}</i>\n🛵 <i>{c.get('Статус', 'не указан')}</i>\n\n"
         await message.answer(result)
     except Exception as e:
         logger.error(f"Ошибка получения курьеров: {e}")
-        await message.answer("⚠️ Ошибка при получении списка курьеров")
+        await message.answer(error_text(e, "⚠️ Ошибка при получении списка курьеров"))
 
 @dp.message(Command("logout"))
 async def cmd_logout(message: types.Message):
     user_id = message.from_user.id
-    if user_id in user_sessions:
-        user_name = user_sessions[user_id].get('name', 'Пользователь')
-        del user_sessions[user_id]
+    session = await user_session(user_id)
+    if session and session.get('client_key'):
+        user_name = session.get('name', 'Пользователь')
+        # иначе следующее сообщение снова авторизует по telegram_id
+        await client_index.logout(user_id)
+        sessions.delete(user_id)
         await message.answer(f"👋 {user_name}, вы успешно вышли из аккаунта!")
     else:
         await message.answer("ℹ️ Вы не авторизованы.")
 
+async def fetch_order_status(order_number):
+    """Заказ и его последнее назначение курьера одним запросом $batch"""
+    order_key = order_index.key_for(order_number)
+    orders, deliveries = await odata_client.read_batch([
+        Query(
+            "Document_ЗаказКлиента",
+            fields=order_index.ORDER_FIELDS,
+            filter=eq("Ref_Key", Guid(order_key)) if order_key else eq("Number", order_number),
+            top=1
+        ),
+        Query(
+            "Document_НазначениеКурьера",
+            fields=["СтатусДоставки", "Курьер/Description"],
+            filter=eq("Заказ_Key", Guid(order_key)) if order_key else eq("Заказ/Number", order_number),
+            expand="Курьер",
+            order="Date desc",
+            top=1
+        ),
+    ])
+    if not orders:
+        return None
+    delivery = {}
+    if deliveries:
+        delivery = {
+            'СтатусДоставки': deliveries[0].get('СтатусДоставки'),
+            'Курьер': (deliveries[0].get('Курьер') or {}).get('Description'),
+        }
+    return order_index.remember(orders[0], delivery)
+
 @dp.message(Command("status"))
 async def cmd_status(message: types.Message):
     args = message.text.split(maxsplit=1)
@@ -573,26 +854,15 @@ async def cmd_status(message: types.Message):
         await message.answer("❌ Формат: /status [номер_заказа]")
         return
     order_number = args[1].strip()
-    order_number_encoded = urllib.parse.quote(order_number)
     try:
-        response = requests.get(f"{ODATA_URL}Document_ЗаказКлиента?$filter=Number eq '{order_number_encoded}'&$format=json", timeout=10)
-        response.raise_for_status()
-        orders = decode_response(response).get('value', [])
-        if not orders:
+        order = order_index.fresh_status(order_number)
+        if order is None:
+            order = await fetch_order_status(order_number)
+        if order is None:
             await message.answer("📋 Заказ не найден")
             return
-        order = orders[0]
-        order_key_encoded = urllib.parse.quote(order['Ref_Key'])
-        delivery_response = requests.get(f"{ODATA_URL}Document_НазначениеКурьера?$filter=Заказ_Key eq guid'{order_key_encoded}'&$expand=Курьер&$format=json", timeout=10)
-        delivery_response.raise_for_status()
-        deliveries = decode_response(delivery_response).get('value', [])
-        delivery_status = "Не назначен"
-        courier_name = "Не назначен"
-        if deliveries:
-            delivery = deliveries[0]
-            delivery_status = delivery.get('СтатусДоставки', 'Не назначен')
-            courier = delivery.get('Курьер', {})
-            courier_name = courier.get('Description', 'Неизвестный курьер')
+        delivery_status = order['delivery'].get('СтатусДоставки') or "Не назначен"
+        courier_name = order['delivery'].get('Курьер') or ("Неизвестный курьер" if order['delivery'] else "Не назначен")
         text = (
             f"<b>📄 Заказ №{order['Number']}</b>\n"
             f"📅 Дата: {datetime.strptime(order['Date'], '%Y-%m-%dT%H:%M:%S').strftime('%d.%m.%Y %H:%M')}\n"
@@ -605,7 +875,7 @@ async def cmd_status(message: types.Message):
         await message.answer(text)
     except Exception as e:
         logger.error(f"Ошибка проверки статуса: {e}")
-        await message.answer("⚠️ Ошибка при проверке статуса заказа")
+        await message.answer(error_text(e, "⚠️ Ошибка при проверке статуса заказа"))
 
 @dp.message(Command("reports"))
 async def cmd_reports(message: types.Message):
@@ -613,7 +883,7 @@ async def cmd_reports(message: types.Message):
     if not await is_user_authenticated(user_id):
         await message.answer("🔐 Пожалуйста, авторизуйтесь с помощью /login")
         return
-    if not user_sessions[user_id].get('is_admin', False):
+    if not await is_admin(user_id):
         await message.answer("❌ Доступ запрещен. Эта команда только для администраторов.")
         return
     builder = InlineKeyboardBuilder()
@@ -629,10 +899,75 @@ async def cmd_reports(message: types.Message):
     builder.adjust(1)
     await message.answer("📊 Выберите отчет:", reply_markup=builder.as_markup())
 
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    user_id = message.from_user.id
+    if not await is_admin(user_id):
+        await message.answer("❌ Доступ запрещен. Эта команда только для администраторов.")
+        return
+    stats = order_pipeline.pipeline_stats()
+    couriers = courier_pool.pool_stats()
+    watcher = status_watcher.stats()
+    index = order_index.stats()
+    history = order_history.stats()
+    known = client_index.stats()
+    text = (
+        "<b>📈 Очередь заказов</b>\n"
+        f"В очереди: {stats['queue_depth']}, воркеров: {stats['workers']}\n"
+        f"Принято: {stats['submitted']}, обработано: {stats['processed']}, ошибок: {stats['failed']}\n"
+    )
+    for name, latency in stats['stages'].items():
+        text += f"▪ {name}: ср. {latency['avg']} с, макс. {latency['max']} с\n"
+    text += (
+        "\n<b>🚴 Курьеры</b>\n"
+        f"Всего: {couriers['total']}, свободно: {couriers['free']}, активных доставок: {couriers['active']}, ждут синхронизации: {couriers['pending_sync']}\n"
+        "\n<b>📮 Outbox</b>\n" + (", ".join(f"{status}: {count}" for status, count in (await outbox.stats()).items()) or "пусто") + "\n"
+        f"\n<b>🔔 Статусы заказов</b>\n"
+        f"Отслеживается: {watcher['tracked']}, опросов: {watcher['polls']}, изменений: {watcher['changes']}, ошибок: {watcher['errors']}\n"
+        f"/status из памяти: {index['hits']}, из 1С: {index['misses']}\n"
+        f"История заказов: из кэша {history['hits']}, дочиток {history['refreshes']}, полных загрузок {history['full_loads']}\n"
+        f"Клиенты по telegram_id: {known['clients']}, из индекса: {known['hits']}, запросов в 1С: {known['lookups']}, загрузок: {known['loads']}"
+    )
+    store = session_store.stats()
+    if 'live' in store:
+        text += (
+            "\n\n<b>🗄 Сессии и корзины в памяти</b>\n"
+            + ", ".join(f"{namespace}: {count}" for namespace, count in store['live'].items()) + "\n"
+            f"Вытеснено: {store['evicted']}, истекло: {store['expired']}, сохранено на диск: {store['spilled']}, возвращено: {store['restored']}"
+        )
+    if dispatcher.enabled():
+        dispatch = dispatcher.stats()
+        text += (
+            "\n\n<b>🗺 Пакетное назначение</b>\n"
+            f"Окно: {dispatch['window']} с, ждут курьера: {dispatch['pending']}\n"
+            f"Назначено: {dispatch['orders']} заказов в {dispatch['groups']} поездок, записей в 1С: {dispatch['writes']}"
+        )
+    pool = odata_client.pool_stats()
+    text += (
+        "\n\n<b>🔌 Соединения с 1С</b>\n"
+        f"Запросов: {pool['requests']}, сейчас: {pool['in_flight']}, пик: {pool['peak_in_flight']} из {pool['limit']}\n"
+        f"Соединений открыто: {pool['connections_created']}, переиспользовано: {pool['connections_reused']}\n"
+    )
+    coalesced = {endpoint: counters for endpoint, counters in odata_client.coalesce_stats().items() if counters['saved']}
+    if coalesced:
+        text += "\n<b>🔁 Объединение одинаковых GET</b>\n" + "".join(
+            f"▪ {endpoint}: {counters['calls']} вызовов, в 1С {counters['upstream']}, сэкономлено {counters['saved']}\n"
+            for endpoint, counters in coalesced.items()
+        )
+    health = circuit_breaker.health_stats()
+    if health:
+        text += "\n<b>🩺 Состояние 1С</b>\n" + "".join(
+            f"▪ {name}: {'🟢' if endpoint['state'] == 'closed' else '🔴' if endpoint['state'] == 'open' else '🟡'} "
+            f"ошибок {endpoint['error_rate']:.0%}"
+            + (f", p99 {endpoint['p99']:.2f} с, таймаут {endpoint['timeout']:.1f} с" if endpoint['p99'] is not None else "") + "\n"
+            for name, endpoint in sorted(health.items())
+        )
+    await message.answer(text)
+
 @dp.callback_query(lambda c: c.data.startswith("report_"))
 async def process_report_selection(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    if not user_sessions[user_id].get('is_admin', False):
+    if not await is_admin(user_id):
         await callback.message.edit_text("❌ Доступ запрещен. Эта команда только для администраторов.")
         await callback.answer()
         return
@@ -640,45 +975,44 @@ async def process_report_selection(callback: types.CallbackQuery):
     await callback.message.edit_text("🔄 Генерируем отчет...")
     try:
         buffer = io.BytesIO()
-        plt.figure(figsize=(12, 6))
         if report_type == "report_orders_by_customer":
-            orders_by_customer()
+            await orders_by_customer()
             plt.savefig(buffer, format='png')
             plt.close()
             buffer.seek(0)
             await callback.message.answer_photo(photo=types.BufferedInputFile(buffer.read(), filename="orders_by_customer.png"))
         elif report_type == "report_order_statuses":
-            order_statuses()
+            await order_statuses()
             plt.savefig(buffer, format='png')
             plt.close()
             buffer.seek(0)
             await callback.message.answer_photo(photo=types.BufferedInputFile(buffer.read(), filename="order_statuses.png"))
         elif report_type == "report_payment_methods":
-            payment_methods()
+            await payment_methods()
             plt.savefig(buffer, format='png')
             plt.close()
             buffer.seek(0)
             await callback.message.answer_photo(photo=types.BufferedInputFile(buffer.read(), filename="payment_methods.png"))
         elif report_type == "report_average_order_value":
-            avg_value = average_order_value()
+            avg_value = await average_order_value()
             buffer.close()
             plt.close()
             await callback.message.answer(f"📊 Средний чек: {avg_value:.2f} руб")
             return
         elif report_type == "report_courier_load":
-            courier_load()
+            await courier_load()
             plt.savefig(buffer, format='png')
             plt.close()
             buffer.seek(0)
             await callback.message.answer_photo(photo=types.BufferedInputFile(buffer.read(), filename="courier_load.png"))
         elif report_type == "report_delivery_statuses":
-            delivery_statuses()
+            await delivery_statuses()
             plt.savefig(buffer, format='png')
             plt.close()
             buffer.seek(0)
             await callback.message.answer_photo(photo=types.BufferedInputFile(buffer.read(), filename="delivery_statuses.png"))
         elif report_type == "report_active_customers":
-            active_customers()
+            await active_customers()
             plt.savefig(buffer, format='png')
             plt.close()
             buffer.seek(0)
@@ -687,39 +1021,49 @@ async def process_report_selection(callback: types.CallbackQuery):
         await callback.message.answer("✅ Отчет успешно сгенерирован!")
     except Exception as e:
         logger.error(f"Ошибка генерации отчета {report_type}: {e}")
-        await callback.message.edit_text(f"⚠️ Ошибка при генерации отчета: {str(e)}")
+        await callback.message.edit_text(error_text(e, f"⚠️ Ошибка при генерации отчета: {str(e)}"))
     await callback.answer()
 
-def get_odata_data(endpoint, params=None):
-    url = urllib.parse.urljoin(ODATA_URL, endpoint)
+async def _fetch_odata_data(endpoint, params):
     try:
-        response = requests.get(url, params=params, headers={'Accept': 'application/json'})
-        response.raise_for_status()
-        return decode_response(response).get('value', [])
+        return await odata_client.get_list(endpoint, params)
     except Exception as e:
-        logger.error(f"Ошибка запроса {url}: {e}")
+        logger.error(f"Ошибка запроса {endpoint}: {e}")
         return []
 
-def orders_by_customer():
-    params = {"$expand": "Клиенты", "$select": "Клиенты/Description,Number,Date,СуммаЗаказов"}
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+async def _iter_odata_data(endpoint, params):
+    try:
+        async for row in odata_client.iter_list(endpoint, params):
+            yield row
+    except Exception as e:
+        # обрыв посреди потока: отчет по неполным данным хуже ошибки
+        logger.error(f"Ошибка запроса {endpoint}: {e}")
+        raise
+
+def get_odata_data(endpoint, params=None, stream=False):
+    # stream=True: асинхронный итератор по строкам без загрузки всего ответа в память
+    if stream:
+        return _iter_odata_data(endpoint, params)
+    return _fetch_odata_data(endpoint, params)
+
+def to_amount(value):
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+async def orders_by_customer():
+    params = {"$expand": "Клиенты", "$select": "Клиенты/Description,СуммаЗаказов"}
+    counts = {}
+    amounts = {}
+    async for order in get_odata_data("Document_ЗаказКлиента", params, stream=True):
+        client = (order.get('Клиенты') or {}).get('Description', 'Без имени')
+        counts[client] = counts.get(client, 0) + 1
+        amounts[client] = amounts.get(client, 0.0) + to_amount(order.get('СуммаЗаказов'))
+    if not counts:
         return
-    df_data = []
-    for order in orders:
-        client = order.get('Клиенты', {})
-        try:
-            amount = float(order.get('СуммаЗаказов', 0) or 0)
-        except (ValueError, TypeError):
-            amount = 0.0
-        df_data.append({
-            'Клиент': client.get('Description', 'Без имени'),
-            'Номер заказа': order.get('Number', ''),
-            'Дата': pd.to_datetime(order.get('Date', None), errors='coerce'),
-            'Сумма': amount
-        })
-    df = pd.DataFrame(df_data)
-    customer_orders = df.groupby('Клиент').agg({'Номер заказа': 'count', 'Сумма': 'sum'}).rename(columns={'Номер заказа': 'Количество заказов'})
+    plt.figure(figsize=(12, 6))
+    customer_orders = pd.DataFrame({'Количество заказов': counts, 'Сумма': amounts}).sort_index()
     customer_orders['Количество заказов'].plot(kind='bar', color='lightblue')
     plt.title('Количество заказов по клиентам')
     plt.xlabel('Клиент')
@@ -727,80 +1071,80 @@ def orders_by_customer():
     plt.xticks(rotation=45)
     plt.tight_layout()
 
-def order_statuses():
+async def order_statuses():
     params = {"$select": "СтатусЗаказа"}
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+    status_counts = Counter()
+    async for order in get_odata_data("Document_ЗаказКлиента", params, stream=True):
+        status_counts[order.get('СтатусЗаказа', 'Не указан')] += 1
+    if not status_counts:
         return
-    df = pd.DataFrame([order.get('СтатусЗаказа', 'Не указан') for order in orders], columns=['Статус'])
-    status_counts = df['Статус'].value_counts()
-    status_counts.plot(kind='pie', autopct='%1.1f%%', startangle=90)
+    plt.figure(figsize=(12, 6))
+    pd.Series(dict(status_counts.most_common())).plot(kind='pie', autopct='%1.1f%%', startangle=90)
     plt.title('Распределение статусов заказов')
     plt.ylabel('')
     plt.tight_layout()
 
-def payment_methods():
+async def payment_methods():
     params = {"$select": "МетодОплаты"}
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+    method_counts = Counter()
+    async for order in get_odata_data("Document_ЗаказКлиента", params, stream=True):
+        method_counts[order.get('МетодОплаты', 'Не указан')] += 1
+    if not method_counts:
         return
-    df = pd.DataFrame([order.get('МетодОплаты', 'Не указан') for order in orders], columns=['Метод'])
-    method_counts = df['Метод'].value_counts()
-    method_counts.plot(kind='bar', color='coral')
+    plt.figure(figsize=(12, 6))
+    pd.Series(dict(method_counts.most_common())).plot(kind='bar', color='coral')
     plt.title('Распределение методов оплаты')
     plt.xlabel('Метод оплаты')
     plt.ylabel('Количество заказов')
     plt.xticks(rotation=45)
     plt.tight_layout()
 
-def average_order_value():
+async def average_order_value():
     params = {"$select": "СуммаЗаказов"}
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
-        return 0.0
-    df = pd.DataFrame([float(order.get('СуммаЗаказов', 0) or 0) for order in orders], columns=['Сумма'])
-    return df['Сумма'].mean()
+    total = 0.0
+    count = 0
+    async for order in get_odata_data("Document_ЗаказКлиента", params, stream=True):
+        total += to_amount(order.get('СуммаЗаказов'))
+        count += 1
+    return total / count if count else 0.0
 
-def courier_load():
-    params = {"$expand": "Курьер", "$select": "Курьер/Description,Date"}
-    assignments = get_odata_data("Document_НазначениеКурьера", params)
-    if not assignments:
+async def courier_load():
+    params = {"$expand": "Курьер", "$select": "Курьер/Description"}
+    courier_counts = Counter()
+    async for assignment in get_odata_data("Document_НазначениеКурьера", params, stream=True):
+        courier_counts[(assignment.get('Курьер') or {}).get('Description', 'Без имени')] += 1
+    if not courier_counts:
         return
-    df = pd.DataFrame([{
-        'Курьер': assignment.get('Курьер', {}).get('Description', 'Без имени'),
-        'Дата': pd.to_datetime(assignment.get('Date', None))
-    } for assignment in assignments])
-    courier_counts = df.groupby('Курьер').size()
-    courier_counts.plot(kind='bar', color='lightgreen')
+    plt.figure(figsize=(12, 6))
+    pd.Series(courier_counts).sort_index().plot(kind='bar', color='lightgreen')
     plt.title('Нагрузка на курьеров (количество назначений)')
     plt.xlabel('Курьер')
     plt.ylabel('Количество назначений')
     plt.xticks(rotation=45)
     plt.tight_layout()
 
-def delivery_statuses():
+async def delivery_statuses():
     params = {"$select": "СтатусДоставки"}
-    assignments = get_odata_data("Document_НазначениеКурьера", params)
-    if not assignments:
+    status_counts = Counter()
+    async for assignment in get_odata_data("Document_НазначениеКурьера", params, stream=True):
+        status_counts[assignment.get('СтатусДоставки', 'Не указан')] += 1
+    if not status_counts:
         return
-    df = pd.DataFrame([assignment.get('СтатусДоставки', 'Не указан') for assignment in assignments], columns=['Статус'])
-    status_counts = df['Статус'].value_counts()
-    status_counts.plot(kind='pie', autopct='%1.1f%%', startangle=90)
+    plt.figure(figsize=(12, 6))
+    pd.Series(dict(status_counts.most_common())).plot(kind='pie', autopct='%1.1f%%', startangle=90)
     plt.title('Распределение статусов доставок')
     plt.ylabel('')
     plt.tight_layout()
 
-def active_customers():
-    params = {"$expand": "Клиенты", "$select": "Клиенты/Description,Number"}
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+async def active_customers():
+    params = {"$expand": "Клиенты", "$select": "Клиенты/Description"}
+    client_counts = Counter()
+    async for order in get_odata_data("Document_ЗаказКлиента", params, stream=True):
+        client_counts[(order.get('Клиенты') or {}).get('Description', 'Без имени')] += 1
+    if not client_counts:
         return
-    df = pd.DataFrame([{
-        'Клиент': order.get('Клиенты', {}).get('Description', 'Без имени'),
-        'Заказ': order.get('Number', '')
-    } for order in orders])
-    active_counts = df.groupby('Клиент').size().nlargest(10)
-    active_counts.plot(kind='bar', color='teal')
+    plt.figure(figsize=(12, 6))
+    pd.Series(dict(client_counts.most_common(10))).plot(kind='bar', color='teal')
     plt.title('Топ-10 активных клиентов')
     plt.xlabel('Клиент')
     plt.ylabel('Количество заказов')
@@ -808,8 +1152,36 @@ def active_customers():
     plt.tight_layout()
 
 async def main():
-    await dp.start_polling(bot)
-    await set_bot_commands(bot)
+    courier_pool.start()
+    order_pipeline.start(process_order)
+    outbox.start(submit_outbox_entry)
+    status_watcher.start(bot.send_message, client_owners)
+    dispatcher.start(bot.send_message)
+    session_store.start()
+    client_index.start()
+    try:
+        await dp.start_polling(bot)
+        await set_bot_commands(bot)
+    finally:
+        status_watcher.stop()
+        await client_index.stop()
+        outbox.stop()
+        await order_pipeline.stop()
+        await dispatcher.stop()
+        await courier_pool.stop()
+        await session_store.close()
+        logger.info(f"Пул соединений 1С: {odata_client.pool_stats()}")
+        logger.info(f"Объединение запросов к 1С: {odata_client.coalesce_stats()}")
+        logger.info(f"Состояние 1С по сущностям: {circuit_breaker.health_stats()}")
+        logger.info(f"Очередь заказов: {order_pipeline.pipeline_stats()}")
+        logger.info(f"Outbox: {await outbox.stats()}")
+        logger.info(f"Статусы заказов: {status_watcher.stats()}")
+        logger.info(f"Индекс заказов: {order_index.stats()}")
+        logger.info(f"История заказов: {order_history.stats()}")
+        logger.info(f"Пакетное назначение курьеров: {dispatcher.stats()}")
+        logger.info(f"Сессии и корзины: {session_store.stats()}")
+        logger.info(f"Индекс клиентов: {client_index.stats()}")
+        await odata_client.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,444 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+# memory - как раньше, в процессе; sqlite - переживает перезапуск; redis - общий для нескольких процессов бота
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.sqlite3')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_PREFIX = os.getenv('REDIS_PREFIX', 'bot:')
+# записи одного обработчика копятся столько секунд и уходят одним пакетом
+WRITE_DELAY = float(os.getenv('SESSION_WRITE_DELAY', '0.05'))
+# ограничения хранилища в памяти; по умолчанию для всех пространств, Store может задать свои
+MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '100000'))
+IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '604800'))
+SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', '60'))
+# файл SQLite для вытесняемых из памяти записей; пусто - вытесненное теряется
+SPILL_PATH = os.getenv('SESSION_SPILL_PATH', '')
+SPILL_NAMESPACES = {name.strip() for name in os.getenv('SESSION_SPILL_NAMESPACES', 'carts').split(',') if name.strip()}
+SCAN_CHUNK = 500
+RETRY_DELAY = 1
+
+logger = logging.getLogger(__name__)
+
+_DELETED = object()
+
+
+def _encode(value):
+    # объекты вроде корзины сохраняются через to_dict и восстанавливаются вызывающим кодом
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError(f"{type(value).__name__} не сериализуется в JSON")
+
+
+class MemoryBackend:
+    """Словари в памяти процесса; объекты хранятся как есть, без сериализации.
+    Размер ограничен: записи, не использовавшиеся idle_ttl секунд, истекают, сверх max_entries вытесняются
+    самые давние. Если задан spill, вытесненные (но не истекшие) записи пространств SPILL_NAMESPACES
+    сохраняются туда и возвращаются при следующем обращении, пока не пролежат там idle_ttl"""
+    durable = False
+
+    def __init__(self, spill=None):
+        # пространство -> OrderedDict ключ -> (значение, время последнего обращения), давние первыми
+        self._data = {}
+        self._limits = {}
+        self._spill = spill
+        # ждут записи в spill: значение или _DELETED
+        self._spilling = {}
+        self._spill_task = None
+        self._stats = {'evicted': 0, 'expired': 0, 'spilled': 0, 'restored': 0}
+
+    def configure(self, namespace, max_entries=MAX_ENTRIES, idle_ttl=IDLE_TTL):
+        self._limits[namespace] = (max_entries, idle_ttl)
+
+    def _entries(self, namespace):
+        return self._data.setdefault(namespace, OrderedDict())
+
+    def _spilled(self, namespace):
+        return self._spill is not None and namespace in SPILL_NAMESPACES
+
+    async def get_many(self, namespace, keys):
+        entries = self._entries(namespace)
+        _, idle_ttl = self._limits.get(namespace, (MAX_ENTRIES, IDLE_TTL))
+        now = time.monotonic()
+        result = {}
+        missing = []
+        for key in keys:
+            entry = entries.get(key)
+            if entry is not None and now - entry[1] > idle_ttl:
+                self._drop(namespace, key, 'expired')
+                entry = None
+            if entry is None:
+                missing.append(key)
+                continue
+            entries[key] = (entry[0], now)
+            entries.move_to_end(key)
+            result[key] = entry[0]
+        if missing and self._spilled(namespace):
+            result.update(await self._restore(namespace, missing))
+        return result
+
+    async def _restore(self, namespace, keys):
+        spilling = self._spilling.get(namespace, {})
+        restored = {key: spilling[key] for key in keys if key in spilling and spilling[key] is not _DELETED}
+        rest = [key for key in keys if key not in spilling]
+        if rest:
+            _, idle_ttl = self._limits.get(namespace, (MAX_ENTRIES, IDLE_TTL))
+            restored.update(await self._spill.get_many(namespace, rest, since=time.time() - idle_ttl))
+        for key, value in restored.items():
+            # запись снова живет в памяти, копия в spill больше не нужна
+            self.write(namespace, key, value)
+            self._queue_spill(namespace, key, _DELETED)
+        self._stats['restored'] += len(restored)
+        return restored
+
+    async def set_many(self, namespace, items):
+        for key, value in items.items():
+            self.write(namespace, key, value)
+
+    async def delete_many(self, namespace, keys):
+        for key in keys:
+            self.write(namespace, key, _DELETED)
+
+    async def items(self, namespace):
+        return {key: entry[0] for key, entry in self._entries(namespace).items()}
+
+    def write(self, namespace, key, value):
+        entries = self._entries(namespace)
+        if value is _DELETED:
+            entries.pop(key, None)
+            if self._spilled(namespace):
+                # иначе удаленная запись вернулась бы из spill
+                self._queue_spill(namespace, key, _DELETED)
+        else:
+            entries[key] = (value, time.monotonic())
+            entries.move_to_end(key)
+        max_entries, _ = self._limits.get(namespace, (MAX_ENTRIES, IDLE_TTL))
+        while len(entries) > max_entries:
+            self._drop(namespace, next(iter(entries)), 'evicted')
+
+    def _drop(self, namespace, key, reason):
+        value, _ = self._entries(namespace).pop(key)
+        self._stats[reason] += 1
+        # истекшая запись заканчивается совсем; сохраняется только вытесненная из-за нехватки места
+        if reason == 'evicted' and self._spilled(namespace):
+            self._queue_spill(namespace, key, value)
+            self._stats['spilled'] += 1
+
+    def _queue_spill(self, namespace, key, value):
+        self._spilling.setdefault(namespace, {})[key] = value
+        if self._spill_task is None:
+            self._spill_task = asyncio.create_task(self._write_spill())
+
+    async def _write_spill(self):
+        try:
+            await self.flush_spill()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения вытесненных записей: {e}")
+            await asyncio.sleep(RETRY_DELAY)
+        finally:
+            self._spill_task = None
+            if any(self._spilling.values()):
+                self._spill_task = asyncio.create_task(self._write_spill())
+
+    async def flush_spill(self):
+        for namespace, spilling in list(self._spilling.items()):
+            batch = dict(spilling)
+            updates = {key: value for key, value in batch.items() if value is not _DELETED}
+            deletes = [key for key, value in batch.items() if value is _DELETED]
+            if updates:
+                await self._spill.set_many(namespace, updates)
+            if deletes:
+                await self._spill.delete_many(namespace, deletes)
+            for key, value in batch.items():
+                if spilling.get(key) is value:
+                    del spilling[key]
+
+    def sweep(self):
+        """Удаляет истекшие записи; они лежат в начале, поэтому проход останавливается на первой живой"""
+        now = time.monotonic()
+        for namespace, entries in self._data.items():
+            _, idle_ttl = self._limits.get(namespace, (MAX_ENTRIES, IDLE_TTL))
+            while entries:
+                key, (_, touched_at) = next(iter(entries.items()))
+                if now - touched_at <= idle_ttl:
+                    break
+                self._drop(namespace, key, 'expired')
+
+    async def prune_spill(self):
+        """Удаляет из spill записи, пролежавшие там дольше idle_ttl своего пространства"""
+        if self._spill is None:
+            return
+        for namespace in SPILL_NAMESPACES:
+            _, idle_ttl = self._limits.get(namespace, (MAX_ENTRIES, IDLE_TTL))
+            await self._spill.prune(namespace, time.time() - idle_ttl)
+
+    def stats(self):
+        return {
+            'live': {namespace: len(entries) for namespace, entries in self._data.items()},
+            **self._stats,
+        }
+
+    async def close(self):
+        if self._spill is not None:
+            await self.flush_spill()
+            await self._spill.close()
+
+
+class SQLiteBackend:
+    """Файл SQLite в режиме WAL: сессии и корзины переживают перезапуск"""
+    durable = True
+
+    def __init__(self, path=SESSION_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS kv (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_updated ON kv (namespace, updated_at)")
+
+    def _select(self, namespace, keys, since=None):
+        with self._lock:
+            if keys is None:
+                return self._conn.execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+            marks = ",".join("?" * len(keys))
+            return self._conn.execute(
+                f"SELECT key, value FROM kv WHERE namespace = ? AND key IN ({marks}) AND updated_at >= ?",
+                (namespace, *keys, since if since is not None else 0)
+            ).fetchall()
+
+    def _write(self, sql, rows):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(sql, rows)
+            self._conn.execute("COMMIT")
+
+    async def get_many(self, namespace, keys, since=None):
+        """since - время (time.time()), раньше которого записанные значения не возвращаются"""
+        if not keys:
+            return {}
+        rows = await asyncio.to_thread(self._select, namespace, list(keys), since)
+        return {key: json.loads(value) for key, value in rows}
+
+    async def set_many(self, namespace, items):
+        now = time.time()
+        await asyncio.to_thread(
+            self._write,
+            "INSERT OR REPLACE INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            [(namespace, key, json.dumps(value, ensure_ascii=False, default=_encode), now) for key, value in items.items()]
+        )
+
+    async def delete_many(self, namespace, keys):
+        await asyncio.to_thread(self._write, "DELETE FROM kv WHERE namespace = ? AND key = ?", [(namespace, key) for key in keys])
+
+    async def items(self, namespace):
+        rows = await asyncio.to_thread(self._select, namespace, None)
+        return {key: json.loads(value) for key, value in rows}
+
+    async def prune(self, namespace, before):
+        await asyncio.to_thread(self._write, "DELETE FROM kv WHERE namespace = ? AND updated_at < ?", [(namespace, before)])
+
+    async def close(self):
+        self._conn.close()
+
+
+class RedisBackend:
+    """Redis или совместимое хранилище (KeyDB, Dragonfly); чтение - MGET, запись - конвейер без транзакции"""
+    durable = True
+
+    def __init__(self, url=REDIS_URL, prefix=REDIS_PREFIX):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("Для SESSION_BACKEND=redis нужен пакет redis: pip install redis")
+        self._redis = redis.from_url(url)
+        self._prefix = prefix
+
+    def _key(self, namespace, key):
+        return f"{self._prefix}{namespace}:{key}"
+
+    async def get_many(self, namespace, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = await self._redis.mget([self._key(namespace, key) for key in keys])
+        return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    async def set_many(self, namespace, items):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(self._key(namespace, key), json.dumps(value, ensure_ascii=False, default=_encode))
+            await pipe.execute()
+
+    async def delete_many(self, namespace, keys):
+        if keys:
+            await self._redis.delete(*(self._key(namespace, key) for key in keys))
+
+    async def items(self, namespace):
+        prefix = self._key(namespace, '')
+        names = [name async for name in self._redis.scan_iter(match=f"{prefix}*", count=SCAN_CHUNK)]
+        result = {}
+        for start in range(0, len(names), SCAN_CHUNK):
+            chunk = names[start:start + SCAN_CHUNK]
+            for name, value in zip(chunk, await self._redis.mget(chunk)):
+                if value is not None:
+                    result[name.decode()[len(prefix):]] = json.loads(value)
+        return result
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+_backend = None
+_stores = []
+_sweep_task = None
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        if SESSION_BACKEND == 'sqlite':
+            _backend = SQLiteBackend()
+        elif SESSION_BACKEND == 'redis':
+            _backend = RedisBackend()
+        else:
+            _backend = MemoryBackend(SQLiteBackend(SPILL_PATH) if SPILL_PATH else None)
+    return _backend
+
+
+class Store:
+    """Пространство ключей (сессии, корзины) поверх выбранного хранилища.
+    Ключи - id пользователей Telegram, приводятся к строке. Изменения копятся и уходят одним пакетом,
+    до отправки чтение видит их локально. Изменив значение на месте, его нужно снова передать в set"""
+
+    def __init__(self, namespace, max_entries=MAX_ENTRIES, idle_ttl=IDLE_TTL):
+        self.namespace = namespace
+        if not backend().durable:
+            backend().configure(namespace, max_entries, idle_ttl)
+        self._pending = {}
+        # отправляются прямо сейчас: до завершения записи читаем их отсюда
+        self._flushing = {}
+        self._flush_task = None
+        _stores.append(self)
+
+    async def get(self, key, default=None):
+        return (await self.get_many([key])).get(str(key), default)
+
+    async def get_many(self, keys):
+        """Несколько значений одним запросом к хранилищу: {str(ключ): значение}"""
+        keys = [str(key) for key in keys]
+        result = {}
+        missing = []
+        for key in keys:
+            local = self._pending if key in self._pending else self._flushing
+            if key not in local:
+                missing.append(key)
+            elif local[key] is not _DELETED:
+                result[key] = local[key]
+        if missing:
+            result.update(await backend().get_many(self.namespace, missing))
+        return result
+
+    async def items(self):
+        result = await backend().items(self.namespace)
+        for key, value in {**self._flushing, **self._pending}.items():
+            if value is _DELETED:
+                result.pop(key, None)
+            else:
+                result[key] = value
+        return result
+
+    def set(self, key, value):
+        self._write(str(key), value)
+
+    def delete(self, key):
+        self._write(str(key), _DELETED)
+
+    def _write(self, key, value):
+        if not backend().durable:
+            # в памяти пакетировать нечего
+            backend().write(self.namespace, key, value)
+            return
+        self._pending[key] = value
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(WRITE_DELAY)
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка записи {self.namespace} в хранилище: {e}")
+            await asyncio.sleep(RETRY_DELAY)
+        finally:
+            self._flush_task = None
+            if self._pending:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        self._flushing = pending
+        updates = {key: value for key, value in pending.items() if value is not _DELETED}
+        deletes = [key for key, value in pending.items() if value is _DELETED]
+        try:
+            if updates:
+                await backend().set_many(self.namespace, updates)
+            if deletes:
+                await backend().delete_many(self.namespace, deletes)
+        except Exception:
+            # не потерять изменения: более новые записи важнее возвращаемых
+            self._pending = {**pending, **self._pending}
+            raise
+        finally:
+            self._flushing = {}
+
+
+async def _sweep_loop():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            backend().sweep()
+            await backend().prune_spill()
+        except Exception as e:
+            logger.error(f"Ошибка очистки хранилища сессий: {e}")
+
+
+def start():
+    """Фоновая очистка истекших записей; нужна только хранилищу в памяти"""
+    global _sweep_task
+    if not backend().durable:
+        _sweep_task = asyncio.create_task(_sweep_loop())
+
+
+def stats():
+    if backend().durable:
+        return {'backend': SESSION_BACKEND}
+    return {'backend': SESSION_BACKEND, **backend().stats()}
+
+
+async def close():
+    """Дописывает накопленные изменения и закрывает хранилище"""
+    if _sweep_task is not None:
+        _sweep_task.cancel()
+    for store in _stores:
+        try:
+            if store._flush_task is not None:
+                await store._flush_task
+            await store.flush()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить {store.namespace}: {e}")
+    if _backend is not None:
+        await _backend.close()
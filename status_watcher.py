@@ -0,0 +1,168 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+import odata_client
+import courier_pool
+import order_index
+from odata_query import Query, Guid, eq, ge, any_of
+
+POLL_INTERVAL = float(os.getenv('STATUS_POLL_INTERVAL', '30'))
+LOOKBACK = timedelta(minutes=float(os.getenv('STATUS_LOOKBACK_MINUTES', '60')))
+# заказ, так и не завершенный за это время, больше не отслеживается
+MAX_AGE = timedelta(hours=float(os.getenv('STATUS_MAX_AGE_HOURS', '24')))
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+logger = logging.getLogger(__name__)
+
+# открытые заказы: последнее известное состояние и владелец в Telegram
+_orders = {}
+_notify = None
+_owners = None
+_task = None
+_stats = {'polls': 0, 'changes': 0, 'errors': 0}
+
+
+def track(order_key, user_id, number, date, status, delivery_status=None, courier=None):
+    """Берет заказ под наблюдение; о следующих изменениях статуса владелец получит сообщение"""
+    _orders[order_key] = {
+        'user_id': user_id,
+        'number': number,
+        'date': datetime.strptime(date, DATE_FORMAT),
+        'status': status,
+        'delivery_status': delivery_status,
+        'courier': courier,
+    }
+
+
+def watermark():
+    """Дата, начиная с которой нужно перечитывать заказы: самый старый открытый заказ, но не раньше LOOKBACK.
+    Более старые открытые заказы перечитываются по Ref_Key"""
+    since = datetime.utcnow() - LOOKBACK
+    if _orders:
+        return max(min(state['date'] for state in _orders.values()), since)
+    return since
+
+
+def _changes(state, status, delivery_status, courier):
+    changes = []
+    if status != state['status']:
+        changes.append(f"🛒 Статус заказа: {status}")
+    if delivery_status and delivery_status != state['delivery_status']:
+        changes.append(f"📦 Статус доставки: {delivery_status}")
+    if courier and courier != state['courier']:
+        changes.append(f"🚴 Курьер: {courier}")
+    return changes
+
+
+async def poll():
+    """Один запрос $batch на заказы и назначения с даты watermark, сравнение с локальным состоянием"""
+    since = watermark()
+    expired = datetime.utcnow() - MAX_AGE
+    for key in [key for key, state in _orders.items() if state['date'] < expired]:
+        del _orders[key]
+    known = set(_orders)
+    stale = [key for key in known if _orders[key]['date'] < since]
+    queries = [
+        Query(
+            "Document_ЗаказКлиента",
+            fields=order_index.ORDER_FIELDS + ["Клиенты_Key"],
+            filter=ge("Date", since)
+        ),
+        Query(
+            "Document_НазначениеКурьера",
+            fields=["Заказ_Key", "СтатусДоставки", "Курьер/Description"],
+            filter=ge("Date", since),
+            expand="Курьер",
+            order="Date"
+        ),
+    ]
+    if stale:
+        queries += [
+            Query(
+                "Document_ЗаказКлиента",
+                fields=order_index.ORDER_FIELDS + ["Клиенты_Key"],
+                filter=any_of(*(eq("Ref_Key", Guid(key)) for key in stale))
+            ),
+            Query(
+                "Document_НазначениеКурьера",
+                fields=["Заказ_Key", "СтатусДоставки", "Курьер/Description"],
+                filter=any_of(*(eq("Заказ_Key", Guid(key)) for key in stale)),
+                expand="Курьер",
+                order="Date"
+            ),
+        ]
+    results = await odata_client.read_batch(queries)
+    orders, assignments = results[0], results[1]
+    if stale:
+        orders = orders + results[2]
+        # все назначения старых заказов идут после выборки по дате и перекрывают ее
+        assignments = assignments + results[3]
+    # по дате, поэтому у переназначенного заказа остается последнее назначение
+    deliveries = {assignment['Заказ_Key']: assignment for assignment in assignments}
+    # список авторизованных - полное чтение хранилища сессий, только если есть кого усыновить
+    untracked = any(
+        order['Ref_Key'] not in _orders and not order_index.is_final(order.get('СтатусЗаказа'))
+        for order in orders
+    )
+    owners = await _owners() if _owners and untracked else {}
+    seen = set()
+    for order in orders:
+        key = order['Ref_Key']
+        seen.add(key)
+        delivery = deliveries.get(key, {})
+        status = order.get('СтатусЗаказа')
+        delivery_status = delivery.get('СтатусДоставки')
+        courier = (delivery.get('Курьер') or {}).get('Description')
+        # назначение не старше заказа, поэтому его отсутствие в выборке значит, что курьера нет
+        order_index.remember(order, {'СтатусДоставки': delivery_status, 'Курьер': courier} if delivery else {})
+        state = _orders.get(key)
+        if order_index.is_final(status, delivery_status):
+            courier_pool.finish(key)
+        if state is None:
+            # заказ, оформленный не через бота: запоминаем без уведомления, если клиент авторизован
+            user_id = owners.get(order.get('Клиенты_Key'))
+            if user_id is not None and not order_index.is_final(status, delivery_status):
+                track(key, user_id, order.get('Number'), order['Date'], status, delivery_status, courier)
+            continue
+        changes = _changes(state, status, delivery_status, courier)
+        state.update({'status': status, 'delivery_status': delivery_status or state['delivery_status'], 'courier': courier or state['courier']})
+        if changes:
+            _stats['changes'] += 1
+            try:
+                await _notify(state['user_id'], f"<b>📄 Заказ №{state['number']}</b>\n" + "\n".join(changes))
+            except Exception as e:
+                logger.error(f"Не удалось отправить статус заказа пользователю {state['user_id']}: {e}")
+        if order_index.is_final(status, delivery_status):
+            _orders.pop(key, None)
+    # удаленные в 1С заказы не должны держать watermark
+    for key in known - seen:
+        _orders.pop(key, None)
+    _stats['polls'] += 1
+
+
+async def _poll_loop():
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        try:
+            await poll()
+        except Exception as e:
+            _stats['errors'] += 1
+            logger.error(f"Ошибка опроса статусов заказов: {e}")
+
+
+def start(notify, owners=None):
+    """notify(user_id, text) отправляет сообщение; async owners() возвращает {Клиенты_Key: user_id} авторизованных клиентов"""
+    global _notify, _owners, _task
+    _notify = notify
+    _owners = owners
+    _task = asyncio.create_task(_poll_loop())
+
+
+def stop():
+    if _task is not None:
+        _task.cancel()
+
+
+def stats():
+    return {'tracked': len(_orders), **_stats}
@@ -0,0 +1,94 @@
+import pytest
+import odata_client
+from odata_client import ODataError, _batch_results, _build_changeset
+
+
+def http_part(status, body, reason='OK'):
+    return (
+        "Content-Type: application/http\r\n"
+        "Content-Transfer-Encoding: binary\r\n"
+        "\r\n"
+        f"HTTP/1.1 {status} {reason}\r\n"
+        "Content-Type: application/json;charset=utf-8\r\n"
+        "\r\n"
+        f"{body}\r\n"
+    )
+
+
+def changeset_response(parts, batch='batchresponse_1', changeset='changesetresponse_1'):
+    inner = "".join(f"--{changeset}\r\n{part}" for part in parts) + f"--{changeset}--\r\n"
+    raw = (
+        f"--{batch}\r\n"
+        f"Content-Type: multipart/mixed; boundary={changeset}\r\n"
+        "\r\n"
+        f"{inner}"
+        f"--{batch}--\r\n"
+    )
+    return f"multipart/mixed; boundary={batch}", raw.encode('utf-8')
+
+
+def read_response(parts, batch='batchresponse_2'):
+    raw = "".join(f"--{batch}\r\n{part}" for part in parts) + f"--{batch}--\r\n"
+    return f'multipart/mixed; boundary="{batch}"', raw.encode('utf-8')
+
+
+@pytest.fixture(autouse=True)
+def reset_batch_support():
+    odata_client._batch_supported = None
+    yield
+    odata_client._batch_supported = None
+
+
+def test_changeset_results_in_order():
+    content_type, raw = changeset_response([
+        http_part(201, '{"Ref_Key": "1", "Number": "0001"}', 'Created'),
+        http_part(204, '', 'No Content'),
+    ])
+    assert _batch_results(202, content_type, raw, 2) == [{"Ref_Key": "1", "Number": "0001"}, {}]
+    assert odata_client._batch_supported is True
+
+
+def test_read_parts_with_bom_and_quoted_boundary():
+    content_type, raw = read_response([
+        http_part(200, '﻿{"value": [{"Ref_Key": "a"}]}'),
+        http_part(200, '{"Ref_Key": "b"}'),
+    ])
+    assert _batch_results(200, content_type, raw, 2) == [{"value": [{"Ref_Key": "a"}]}, {"Ref_Key": "b"}]
+
+
+def test_lf_only_line_endings():
+    content_type, raw = read_response([http_part(200, '{"x": 1}')])
+    assert _batch_results(200, content_type, raw.replace(b'\r\n', b'\n'), 1) == [{"x": 1}]
+
+
+def test_failed_part_raises_with_its_status():
+    content_type, raw = changeset_response([http_part(400, '{"odata.error": "bad"}', 'Bad Request')])
+    with pytest.raises(ODataError) as error:
+        _batch_results(202, content_type, raw, 2)
+    assert error.value.status == 400
+    assert 'bad' in error.value.text
+
+
+def test_missing_parts_raise():
+    content_type, raw = changeset_response([http_part(201, '{}', 'Created')])
+    with pytest.raises(ODataError):
+        _batch_results(202, content_type, raw, 2)
+
+
+def test_non_multipart_response_raises():
+    with pytest.raises(ODataError) as error:
+        _batch_results(500, 'application/json', b'{"odata.error": "down"}', 1)
+    assert error.value.status == 500
+
+
+def test_changeset_request_layout():
+    boundary, body = _build_changeset([
+        ("POST", "Document_ЗаказКлиента", {"Ref_Key": "k", "Сумма": 1.5}),
+        ("PATCH", "Document_ЗаказКлиента(guid'k')", {"СтатусЗаказа": "В обработке"}),
+    ])
+    text = body.decode('utf-8')
+    assert text.startswith(f"--{boundary}\r\n")
+    assert text.endswith(f"--{boundary}--\r\n")
+    assert text.count("Content-ID: ") == 2
+    assert "\r\nPOST http" in text and "\r\nPATCH http" in text
+    assert '{"Ref_Key": "k", "Сумма": 1.5}' in text
@@ -0,0 +1,42 @@
+import random
+from cart import Cart, _cents
+
+
+def assert_consistent(cart):
+    assert cart._total_cents == sum(_cents(line.subtotal) for line in cart)
+
+
+def test_repeated_add_reprices_line():
+    cart = Cart()
+    cart.add('a', 'Молоко', 100.0, 1)
+    cart.add('a', 'Молоко', 120.0, 1)
+    assert cart.total == 240.0
+    assert cart.render() == "▪ Молоко x2 = 240.00 руб.\n"
+    assert_consistent(cart)
+    cart.set_price('a', 130.0)
+    assert cart.total == 260.0
+    assert_consistent(cart)
+
+
+def test_total_matches_lines_after_random_edits():
+    rng = random.Random(1)
+    cart = Cart()
+    for _ in range(500):
+        key = rng.choice('abcde')
+        action = rng.random()
+        if action < 0.6:
+            cart.add(key, key, rng.choice([0.1, 9.99, 100.0, 120.5]), rng.randint(1, 5))
+        elif action < 0.8:
+            cart.remove(key)
+        elif key in cart.lines:
+            cart.set_price(key, rng.choice([0.3, 15.15, 99.99]))
+        assert_consistent(cart)
+
+
+def test_round_trip_keeps_total():
+    cart = Cart()
+    cart.add('a', 'Хлеб', 45.5, 2)
+    cart.add('b', 'Сыр', 300.0, 1)
+    restored = Cart.from_dict(cart.to_dict())
+    assert restored.total == cart.total == 391.0
+    assert_consistent(restored)
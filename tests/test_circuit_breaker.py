@@ -0,0 +1,111 @@
+import asyncio
+import pytest
+import circuit_breaker
+import odata_client
+from circuit_breaker import CircuitOpenError, EndpointHealth
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def trip(health):
+    for _ in range(circuit_breaker.MIN_CALLS):
+        health.allow()
+        health.record(False)
+
+
+def test_opens_after_error_threshold(clock):
+    health = EndpointHealth('GET X')
+    for _ in range(circuit_breaker.MIN_CALLS - 1):
+        health.record(False)
+    assert health.state == 'closed'
+    health.record(False)
+    assert health.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        health.allow()
+
+
+def test_half_open_lets_one_probe_and_closes_on_success(clock):
+    health = EndpointHealth('GET X')
+    trip(health)
+    clock[0] += circuit_breaker.OPEN_SECONDS
+    health.allow()
+    assert health.state == 'half_open'
+    with pytest.raises(CircuitOpenError):
+        health.allow()
+    health.record(True, 0.1)
+    assert health.state == 'closed'
+    health.allow()
+
+
+def test_failed_probe_reopens(clock):
+    health = EndpointHealth('GET X')
+    trip(health)
+    clock[0] += circuit_breaker.OPEN_SECONDS
+    health.allow()
+    health.record(False)
+    assert health.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        health.allow()
+
+
+def test_cancelled_probe_frees_the_slot(clock):
+    health = EndpointHealth('GET X')
+    trip(health)
+    clock[0] += circuit_breaker.OPEN_SECONDS
+    health.allow()
+    health.cancel()
+    health.allow()
+    assert health.probe_in_flight
+
+
+def test_timeout_follows_p99_within_caller_limit():
+    health = EndpointHealth('GET X')
+    assert health.timeout(10) == 10
+    for _ in range(circuit_breaker.MIN_CALLS):
+        health.record(True, 0.05)
+    assert health.timeout(10) == circuit_breaker.MIN_TIMEOUT
+    for _ in range(circuit_breaker.WINDOW):
+        health.record(True, 2.0)
+    assert health.timeout(10) == 4.0
+    for _ in range(circuit_breaker.WINDOW):
+        health.record(True, 8.0)
+    assert health.timeout(10) == 10
+    assert health.timeout() == 16.0
+
+
+def test_endpoints_are_split_by_method():
+    assert circuit_breaker.endpoint("Document_Заказ(guid'1')") is circuit_breaker.endpoint("Document_Заказ")
+    assert circuit_breaker.endpoint("Document_Заказ", 'POST') is not circuit_breaker.endpoint("Document_Заказ")
+    assert circuit_breaker.endpoint('$batch', 'POST') is not circuit_breaker.endpoint('$batch', 'GET')
+
+
+def test_retry_budget_limits_retries():
+    budget = circuit_breaker.RetryBudget(ratio=0.5, max_tokens=2)
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+    budget.on_request()
+    budget.on_request()
+    assert budget.try_spend()
+
+
+def test_non_json_probe_response_releases_the_circuit(clock, monkeypatch):
+    health = circuit_breaker.endpoint('Catalog_Проба')
+    trip(health)
+    clock[0] += circuit_breaker.OPEN_SECONDS
+    responses = [b'<html>1C error</html>', b'{"ok": true}']
+
+    async def send(*args):
+        return odata_client.decode_body(responses.pop(0))
+
+    monkeypatch.setattr(odata_client, '_send', send)
+    with pytest.raises(ValueError):
+        asyncio.run(odata_client.request('GET', 'Catalog_Проба'))
+    assert health.state == 'open' and not health.probe_in_flight
+    clock[0] += circuit_breaker.OPEN_SECONDS
+    assert asyncio.run(odata_client.request('GET', 'Catalog_Проба')) == {"ok": True}
+    assert health.state == 'closed'
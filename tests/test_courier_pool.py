@@ -0,0 +1,120 @@
+import asyncio
+import pytest
+import courier_pool
+import odata_client
+
+
+def couriers(count):
+    return [{'Ref_Key': f'c{i}', 'Description': f'Курьер {i}', 'Статус': courier_pool.FREE} for i in range(count)]
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    for state in (courier_pool._couriers, courier_pool._load, courier_pool._reserved,
+                  courier_pool._committed, courier_pool._available_since, courier_pool._pending):
+        state.clear()
+    monkeypatch.setattr(courier_pool, '_loaded', False)
+    monkeypatch.setattr(courier_pool, '_load_lock', asyncio.Lock())
+    monkeypatch.setattr(courier_pool, '_sync_event', None)
+    one_c = {'couriers': couriers(3), 'assignments': [], 'reads': 0, 'gate': None}
+
+    async def read_batch(queries, timeout=15):
+        one_c['reads'] += 1
+        # ответ отражает 1С на момент начала чтения
+        snapshot = [list(one_c['couriers']), list(one_c['assignments'])]
+        if one_c['gate'] is not None:
+            await one_c['gate'].wait()
+        await asyncio.sleep(0)
+        return snapshot
+
+    monkeypatch.setattr(odata_client, 'read_batch', read_batch)
+    return one_c
+
+
+def loads():
+    return {key: len(orders) for key, orders in courier_pool._load.items() if orders}
+
+
+@pytest.mark.parametrize("max_load", [1, 2])
+def test_concurrent_reserve_never_exceeds_max_load(pool, monkeypatch, max_load):
+    monkeypatch.setattr(courier_pool, 'MAX_LOAD', max_load)
+
+    async def run():
+        return await asyncio.gather(*(courier_pool.reserve(f'o{i}') for i in range(10)))
+
+    results = asyncio.run(run())
+    given = [courier['Ref_Key'] for courier in results if courier is not None]
+    assert pool['reads'] == 1
+    assert len(given) == 3 * max_load
+    assert all(given.count(key) <= max_load for key in set(given))
+    assert all(count <= max_load for count in loads().values())
+
+
+def test_load_overlapping_commit_keeps_committed_order(pool):
+    async def run():
+        await courier_pool.ensure_loaded()
+        pool['gate'] = asyncio.Event()
+        refresh = asyncio.create_task(courier_pool.load())
+        await asyncio.sleep(0)
+        courier = await courier_pool.reserve('o1')
+        courier_pool.commit('o1')
+        pool['gate'].set()
+        await refresh
+        return courier
+
+    courier = asyncio.run(run())
+    assert 'o1' in courier_pool._load[courier['Ref_Key']]
+    assert courier_pool._couriers[courier['Ref_Key']]['Статус'] == courier_pool.BUSY
+    # после чтения, начатого позже записи, заказ берется уже из 1С
+    pool['gate'] = None
+    pool['assignments'] = [{'Заказ_Key': 'o1', 'Курьер_Key': courier['Ref_Key'], 'СтатусДоставки': 'Назначен', 'Заказ': {'СтатусЗаказа': 'В обработке'}}]
+    asyncio.run(courier_pool.load())
+    assert courier_pool._committed == {}
+    assert 'o1' in courier_pool._load[courier['Ref_Key']]
+
+
+def test_reserved_order_survives_reload(pool):
+    async def run():
+        courier = await courier_pool.reserve('o1')
+        await courier_pool.load()
+        return courier
+
+    courier = asyncio.run(run())
+    assert courier_pool._reserved == {'o1': courier['Ref_Key']}
+    assert loads() == {courier['Ref_Key']: 1}
+
+
+def test_finish_frees_courier_and_queues_sync(pool):
+    async def run():
+        courier = await courier_pool.reserve('o1')
+        courier_pool.commit('o1')
+        courier_pool._pending.clear()
+        courier_pool.finish('o1')
+        return courier
+
+    courier = asyncio.run(run())
+    key = courier['Ref_Key']
+    assert courier_pool._couriers[key]['Статус'] == courier_pool.FREE
+    assert courier_pool._pending == {key: courier_pool.FREE}
+    assert loads() == {}
+
+
+def test_release_does_not_sync(pool):
+    async def run():
+        await courier_pool.reserve('o1')
+        courier_pool.release('o1')
+
+    asyncio.run(run())
+    assert courier_pool._pending == {}
+    assert loads() == {}
+    assert courier_pool.pool_stats()['free'] == 3
+
+
+def test_final_order_status_does_not_count_as_load(pool):
+    pool['assignments'] = [
+        {'Заказ_Key': 'done', 'Курьер_Key': 'c0', 'СтатусДоставки': 'В пути', 'Заказ': {'СтатусЗаказа': 'Выполнен'}},
+        {'Заказ_Key': 'open', 'Курьер_Key': 'c1', 'СтатусДоставки': 'В пути', 'Заказ': {'СтатусЗаказа': 'В обработке'}},
+    ]
+    asyncio.run(courier_pool.load())
+    assert loads() == {'c1': 1}
+    assert courier_pool._couriers['c1']['Статус'] == courier_pool.BUSY
@@ -0,0 +1,67 @@
+import os
+import asyncio
+import pytest
+
+# токен из .env может быть заглушкой, Bot проверяет его формат
+os.environ['BOT_TOKEN'] = '1:x'
+
+import server
+import outbox
+import odata_client
+import order_pipeline
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = {'batch': [], 'done': [], 'failed': [], 'sent': []}
+
+    async def batch(writes, timeout=15):
+        calls['batch'].append(writes)
+        raise odata_client.ODataError(400, "Ref_Key уже существует")
+
+    async def read_batch(queries, timeout=15):
+        return [[{'Ref_Key': 'order-1', 'Number': '0042'}], [{'Курьер_Key': 'c1', 'Курьер': {'Description': 'Петр'}}]]
+
+    async def mark_done(entry_id, order_number=None):
+        calls['done'].append((entry_id, order_number))
+
+    async def mark_failed(entry_id, error):
+        calls['failed'].append(entry_id)
+
+    async def send_message(user_id, text, **kwargs):
+        calls['sent'].append(text)
+
+    monkeypatch.setattr(odata_client, 'batch', batch)
+    monkeypatch.setattr(odata_client, 'read_batch', read_batch)
+    monkeypatch.setattr(outbox, 'mark_done', mark_done)
+    monkeypatch.setattr(outbox, 'mark_failed', mark_failed)
+    monkeypatch.setattr(server.bot, 'send_message', send_message)
+    monkeypatch.setattr(server.dispatcher, 'DISPATCH_WINDOW', 0)
+    monkeypatch.setattr(order_pipeline, 'record', lambda name, seconds: None)
+    return calls
+
+
+def outbox_entry():
+    return {
+        'id': 7,
+        'attempts': 0,
+        'payload': {
+            'user_id': 1,
+            'order_data': {'Ref_Key': 'order-1', 'Date': '2026-01-01T10:00:00', 'СтатусЗаказа': 'Новый', 'Клиенты_Key': 'client-1'},
+            'address': 'ул. Ленина 1',
+            'total': 100.0,
+            'cart': [],
+        },
+    }
+
+
+def test_replayed_entry_without_attempts_is_not_written_twice(calls, monkeypatch):
+    jobs = []
+    monkeypatch.setattr(order_pipeline, 'submit', jobs.append)
+    server.submit_outbox_entry(outbox_entry())
+    asyncio.run(server.process_order(jobs[0]))
+    assert calls['batch'] == []
+    assert calls['failed'] == []
+    assert calls['done'] == [(7, '0042')]
+    assert "Заказ №0042 создан" in calls['sent'][0]
+    assert "Петр" in calls['sent'][0]
@@ -0,0 +1,60 @@
+import json
+import random
+import pytest
+from odata_client import _ValueStream
+
+BODY = {
+    "odata.metadata": "http://localhost/odata/$metadata#Catalog_Товары",
+    "odata.count": "3",
+    "value": [
+        {"Ref_Key": "a", "Description": "Молоко \"3,2%\"", "Цена": 89.9, "Теги": ["]", "}"]},
+        {"Ref_Key": "b", "Description": "Хлеб", "Цена": 45, "Вложенное": {"value": [1, 2]}},
+        {"Ref_Key": "c", "Description": "", "Цена": -1.5e2, "Пусто": None},
+    ],
+}
+
+
+def feed_in_chunks(text, sizes):
+    parser = _ValueStream()
+    rows = []
+    pos = 0
+    for size in sizes:
+        rows += parser.feed(text[pos:pos + size])
+        pos += size
+    rows += parser.feed(text[pos:], final=True)
+    return rows
+
+
+def test_whole_body():
+    text = json.dumps(BODY, ensure_ascii=False)
+    assert feed_in_chunks(text, []) == BODY["value"]
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_random_chunk_sizes(indent):
+    text = json.dumps(BODY, ensure_ascii=False, indent=indent)
+    rng = random.Random(indent or 0)
+    for _ in range(200):
+        sizes = [rng.randint(1, 7) for _ in range(len(text) // 3)]
+        assert feed_in_chunks(text, sizes) == BODY["value"]
+
+
+def test_number_split_at_chunk_end():
+    text = '{"value": [12345, 6]}'
+    assert feed_in_chunks(text, [14, 1, 1]) == [12345, 6]
+
+
+def test_empty_value():
+    assert feed_in_chunks('{"odata.metadata": "x", "value": []}', [5, 5]) == []
+
+
+def test_truncated_body_raises():
+    text = json.dumps(BODY, ensure_ascii=False)
+    with pytest.raises(ValueError):
+        feed_in_chunks(text[:len(text) // 2], [10])
+
+
+@pytest.mark.parametrize("text", ['[1, 2]', '{"value": 5}', '{"value": []} x'])
+def test_malformed_body_raises(text):
+    with pytest.raises(ValueError):
+        feed_in_chunks(text, [])
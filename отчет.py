@@ -1,21 +1,32 @@
-import requests
 import matplotlib.pyplot as plt
 import pandas as pd
-from urllib.parse import urljoin
+from collections import Counter
 from datetime import datetime
-# Настройки
-BASE_URL = "http://localhost/proekt/odata/standard.odata/"
-HEADERS = {'Accept': 'application/json'}
+import odata_client
 
-def get_odata_data(endpoint, params=None):
-    """Запрашивает данные из OData-сервиса"""
-    url = urljoin(BASE_URL, endpoint)
+def _iter_odata_data(endpoint, params):
+    rows = odata_client.iter_list(endpoint, params)
     try:
-        response = requests.get(url, params=params, headers=HEADERS)
-        response.raise_for_status()
-        return response.json().get('value', [])
+        while True:
+            yield odata_client.run_sync(rows.__anext__())
+    except StopAsyncIteration:
+        pass
     except Exception as e:
-        print(f"🚨 Ошибка при запросе {url}: {str(e)}")
+        # обрыв посреди потока: отчет по неполным данным хуже ошибки
+        print(f"🚨 Ошибка при запросе {endpoint}: {str(e)}")
+        raise
+    finally:
+        odata_client.run_sync(rows.aclose())
+
+def get_odata_data(endpoint, params=None, stream=False):
+    """Запрашивает данные из OData-сервиса через общий пул соединений.
+    stream=True возвращает генератор строк, не держа весь ответ в памяти"""
+    if stream:
+        return _iter_odata_data(endpoint, params)
+    try:
+        return odata_client.run_sync(odata_client.get_list(endpoint, params))
+    except Exception as e:
+        print(f"🚨 Ошибка при запросе {endpoint}: {str(e)}")
         return []
 
 # 2. Отчеты по заказам 
@@ -23,17 +34,13 @@ def orders_by_customer():
     """Отчет по заказам клиентов"""
     params = {
         "$expand": "Клиенты",
-        "$select": "Клиенты/Description,Number,Date,СуммаЗаказов"
+        "$select": "Клиенты/Description,Number,СуммаЗаказов"
     }
     
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
-        print("❌ Нет данных о заказах клиентов")
-        return
-
-    # Создаем DataFrame с обработкой None и пустых значений
-    df_data = []
-    for order in orders:
+    # Агрегируем по мере чтения, не собирая все заказы в DataFrame
+    counts = {}
+    amounts = {}
+    for order in get_odata_data("Document_ЗаказКлиента", params, stream=True):
         client = order.get('Клиенты', None)
         client_description = client.get('Description', 'Без имени') if client else 'Без имени'
         
@@ -44,19 +51,13 @@ def orders_by_customer():
             amount = 0.0
             print(f"⚠️ Заказ {order.get('Number', 'Unknown')} имеет некорректное значение СуммаЗаказов: {order.get('СуммаЗаказов', 'None')}")
 
-        df_data.append({
-            'Клиент': client_description,
-            'Номер заказа': order.get('Number', ''),
-            'Дата': pd.to_datetime(order.get('Date', None), errors='coerce'),
-            'Сумма': amount
-        })
-    
-    df = pd.DataFrame(df_data)
-    
-    customer_orders = df.groupby('Клиент').agg({
-        'Номер заказа': 'count',
-        'Сумма': 'sum'
-    }).rename(columns={'Номер заказа': 'Количество заказов'})
+        counts[client_description] = counts.get(client_description, 0) + 1
+        amounts[client_description] = amounts.get(client_description, 0.0) + amount
+    if not counts:
+        print("❌ Нет данных о заказах клиентов")
+        return
+
+    customer_orders = pd.DataFrame({'Количество заказов': counts, 'Сумма': amounts}).sort_index()
     
     # График
     plt.figure(figsize=(12, 6))
@@ -74,17 +75,14 @@ def order_statuses():
         "$select": "СтатусЗаказа"
     }
     
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+    status_counts = Counter(order.get('СтатусЗаказа', 'Не указан') for order in get_odata_data("Document_ЗаказКлиента", params, stream=True))
+    if not status_counts:
         print("❌ Нет данных о статусах заказов")
         return
-
-    df = pd.DataFrame([order.get('СтатусЗаказа', 'Не указан') for order in orders], columns=['Статус'])
-    status_counts = df['Статус'].value_counts()
     
     # График
     plt.figure(figsize=(8, 8))
-    status_counts.plot(kind='pie', autopct='%1.1f%%', startangle=90)
+    pd.Series(dict(status_counts.most_common())).plot(kind='pie', autopct='%1.1f%%', startangle=90)
     plt.title('Распределение статусов заказов')
     plt.ylabel('')
     plt.tight_layout()
@@ -96,17 +94,14 @@ def payment_methods():
         "$select": "МетодОплаты"
     }
     
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+    method_counts = Counter(order.get('МетодОплаты', 'Не указан') for order in get_odata_data("Document_ЗаказКлиента", params, stream=True))
+    if not method_counts:
         print("❌ Нет данных о методах оплаты")
         return
-
-    df = pd.DataFrame([order.get('МетодОплаты', 'Не указан') for order in orders], columns=['Метод'])
-    method_counts = df['Метод'].value_counts()
     
     # График
     plt.figure(figsize=(10, 6))
-    method_counts.plot(kind='bar', color='coral')
+    pd.Series(dict(method_counts.most_common())).plot(kind='bar', color='coral')
     plt.title('Распределение методов оплаты')
     plt.xlabel('Метод оплаты')
     plt.ylabel('Количество заказов')
@@ -120,13 +115,16 @@ def average_order_value():
         "$select": "СуммаЗаказов"
     }
     
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+    total = 0.0
+    count = 0
+    for order in get_odata_data("Document_ЗаказКлиента", params, stream=True):
+        total += float(order.get('СуммаЗаказов', 0) or 0)
+        count += 1
+    if not count:
         print("❌ Нет данных о заказах")
         return
 
-    df = pd.DataFrame([float(order.get('СуммаЗаказов', 0)) for order in orders], columns=['Сумма'])
-    avg_value = df['Сумма'].mean()
+    avg_value = total / count
     
     print(f"📊 Средний чек: {avg_value:.2f} руб")
     # Простой текстовый вывод, так как график для одного значения менее информативен
@@ -136,24 +134,20 @@ def courier_load():
     """Отчет по нагрузке на курьеров"""
     params = {
         "$expand": "Курьер",
-        "$select": "Курьер/Description,Date"
+        "$select": "Курьер/Description"
     }
     
-    assignments = get_odata_data("Document_НазначениеКурьера", params)
-    if not assignments:
+    courier_counts = Counter(
+        (assignment.get('Курьер') or {}).get('Description', 'Без имени')
+        for assignment in get_odata_data("Document_НазначениеКурьера", params, stream=True)
+    )
+    if not courier_counts:
         print("❌ Нет данных о назначениях курьеров")
         return
-
-    df = pd.DataFrame([{
-        'Курьер': assignment.get('Курьер', {}).get('Description', 'Без имени'),
-        'Дата': pd.to_datetime(assignment.get('Date', None))
-    } for assignment in assignments])
-    
-    courier_counts = df.groupby('Курьер').size()
     
     # График
     plt.figure(figsize=(12, 6))
-    courier_counts.plot(kind='bar', color='lightgreen')
+    pd.Series(courier_counts).sort_index().plot(kind='bar', color='lightgreen')
     plt.title('Нагрузка на курьеров (количество назначений)')
     plt.xlabel('Курьер')
     plt.ylabel('Количество назначений')
@@ -167,17 +161,14 @@ def delivery_statuses():
         "$select": "СтатусДоставки"
     }
     
-    assignments = get_odata_data("Document_НазначениеКурьера", params)
-    if not assignments:
+    status_counts = Counter(assignment.get('СтатусДоставки', 'Не указан') for assignment in get_odata_data("Document_НазначениеКурьера", params, stream=True))
+    if not status_counts:
         print("❌ Нет данных о статусах доставок")
         return
-
-    df = pd.DataFrame([assignment.get('СтатусДоставки', 'Не указан') for assignment in assignments], columns=['Статус'])
-    status_counts = df['Статус'].value_counts()
     
     # График
     plt.figure(figsize=(8, 8))
-    status_counts.plot(kind='pie', autopct='%1.1f%%', startangle=90)
+    pd.Series(dict(status_counts.most_common())).plot(kind='pie', autopct='%1.1f%%', startangle=90)
     plt.title('Распределение статусов доставок')
     plt.ylabel('')
     plt.tight_layout()
@@ -188,24 +179,20 @@ def active_customers():
     """Отчет по активным клиентам"""
     params = {
         "$expand": "Клиенты",
-        "$select": "Клиенты/Description,Number"
+        "$select": "Клиенты/Description"
     }
     
-    orders = get_odata_data("Document_ЗаказКлиента", params)
-    if not orders:
+    client_counts = Counter(
+        (order.get('Клиенты') or {}).get('Description', 'Без имени')
+        for order in get_odata_data("Document_ЗаказКлиента", params, stream=True)
+    )
+    if not client_counts:
         print("❌ Нет данных о клиентах")
         return
-
-    df = pd.DataFrame([{
-        'Клиент': order.get('Клиенты', {}).get('Description', 'Без имени'),
-        'Заказ': order.get('Number', '')
-    } for order in orders])
-    
-    active_counts = df.groupby('Клиент').size().nlargest(10)
     
     # График
     plt.figure(figsize=(12, 6))
-    active_counts.plot(kind='bar', color='teal')
+    pd.Series(dict(client_counts.most_common(10))).plot(kind='bar', color='teal')
     plt.title('Топ-10 активных клиентов')
     plt.xlabel('Клиент')
     plt.ylabel('Количество заказов')
@@ -228,6 +215,8 @@ if __name__ == "__main__":
     # goods_movement()
     # revenue_by_period()
     active_customers()
+    print(f"🔌 Пул соединений: {odata_client.pool_stats()}")
+    odata_client.run_sync(odata_client.close())
     # telegram_customers()
     # incomplete_orders()
     # low_stock_products()
\ No newline at end of file